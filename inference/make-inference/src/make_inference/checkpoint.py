@@ -0,0 +1,78 @@
+from loguru import logger
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from .ml_helper import NO_DATA_CLASS, window_values
+
+
+class WindowCheckpoint:
+    """
+    Keeps the classes of the classified windows of a scene on disk, to resume an interrupted run.
+
+    The checkpoint holds one class per window of the scene grid and a bitmap of the
+    completed windows. It is saved atomically at most every `interval` seconds, so a
+    run killed at any point loses at most `interval` seconds of work. A run restarted
+    with the same fingerprint (item, model, window grid and options) only classifies the
+    windows missing from the bitmap, and replays the others into the writer, so the
+    output is the same as the one of an uninterrupted run. With `probability`, the
+    probability of every class is kept too.
+    """
+
+    def __init__(self, path, windows, fingerprint, interval=60, probability=False):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.interval = interval
+        self.index = {(window.row_off, window.col_off): i for i, window in enumerate(windows)}
+        self.classes = window_values(len(windows), NO_DATA_CLASS, probability)
+        self.done = np.zeros(len(windows), dtype=bool)
+        self.saved_at = time.monotonic()
+        self.load()
+
+    @staticmethod
+    def fingerprint_of(**values):
+        """Hash of the values that must match for a checkpoint to be resumed."""
+        return hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with np.load(self.path) as data:
+            if str(data["fingerprint"]) != self.fingerprint or data["classes"].shape != self.classes.shape:
+                logger.warning(f"Checkpoint {self.path} belongs to another item, model, window grid or options, ignoring it")
+                return
+            self.classes = data["classes"]
+            self.done = np.unpackbits(data["done"], count=len(self.classes)).astype(bool)
+        logger.info(f"Resuming from {self.path}, {self.done.sum()} of {len(self.done)} windows already classified")
+
+    def split(self, windows):
+        """
+        Split windows between the ones still to classify and the ones restored from the checkpoint.
+
+        Returns:
+        - (pending windows, restored windows, classes of the restored windows)
+        """
+        indexes = np.array([self.index[(window.row_off, window.col_off)] for window in windows], dtype=np.int64)
+        done = self.done[indexes] if len(indexes) else np.zeros(0, dtype=bool)
+        pending = [window for window, is_done in zip(windows, done) if not is_done]
+        restored = [window for window, is_done in zip(windows, done) if is_done]
+        return pending, restored, self.classes[indexes[done]]
+
+    def update(self, windows, classes):
+        indexes = [self.index[(window.row_off, window.col_off)] for window in windows]
+        self.classes[indexes] = classes
+        self.done[indexes] = True
+        if time.monotonic() - self.saved_at >= self.interval:
+            self.save()
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, fingerprint=self.fingerprint, classes=self.classes, done=np.packbits(self.done))
+        os.replace(tmp_path, self.path)
+        self.saved_at = time.monotonic()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
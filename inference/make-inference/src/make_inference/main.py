@@ -1,13 +1,35 @@
 from loguru import logger
 import os
-import pystac
+import sys
 import click
-from georeader.geotensor import GeoTensor
 from tqdm import tqdm
 import warnings
 import numpy as np
-import onnxruntime as ort
+import rasterio.windows
+from concurrent.futures import ThreadPoolExecutor
 from .ml_helper import *
+from .session import (
+    DEFAULT_CACHE_DIR,
+    DEFAULT_MODEL_PATH,
+    EXECUTION_MODES,
+    GRAPH_OPTIMIZATION_LEVELS,
+    MODEL_VARIANTS,
+    create_session,
+    file_hash,
+    variant_path,
+)
+from .checkpoint import WindowCheckpoint
+from .parallel import StripePool
+from .prediction_cache import PredictionCache
+from .remote import (
+    apply_remote_profile,
+    block_cache_size,
+    count_requests,
+    raise_block_cache,
+    request_counters,
+    stop_counting,
+)
+from .writers import prediction_writer
 
 warnings.filterwarnings("ignore")
 
@@ -20,93 +42,668 @@ warnings.filterwarnings("ignore")
     "--input_reference",
     "-i",
     "input_reference",
-    help="Url to sentinel-2 STAC Item to provide inference on tif images for 12 common bands(excluding cirrus)",
+    help="Url to sentinel-2 STAC Item to provide inference on tif images for 12 common bands(excluding cirrus), "
+    "or to a STAC Catalog of such items. Can be repeated to classify many scenes in one run",
     type=click.Path(),
     required=True,
+    multiple=True,
+)
+@click.option(
+    "--bbox",
+    "bbox",
+    help="Area of interest as min lon, min lat, max lon, max lat in EPSG:4326, "
+    "only the windows intersecting it are classified and the output is cropped to them",
+    type=float,
+    nargs=4,
+    default=None,
+)
+@click.option(
+    "--aoi",
+    "aoi",
+    help="Path or url to a GeoJSON geometry, Feature or FeatureCollection in EPSG:4326 used as area of interest, like --bbox",
+    type=click.Path(),
+    default=None,
+)
+@click.option(
+    "--batch_size",
+    "-b",
+    "batch_size",
+    help="Number of windows stacked into a single ONNX session call",
+    type=click.IntRange(min=1),
+    default=64,
+    show_default=True,
+)
+@click.option(
+    "--readers",
+    "readers",
+    help="Number of threads reading strips ahead of the model, shared by all the scenes",
+    type=click.IntRange(min=1),
+    default=2,
+    show_default=True,
+)
+@click.option(
+    "--gdal_threads",
+    "gdal_threads",
+    help="Threads GDAL decodes the blocks of a band read on, as GDAL_NUM_THREADS, a number or ALL_CPUS",
+    default="ALL_CPUS",
+    show_default=True,
+    envvar="MAKE_INFERENCE_GDAL_THREADS",
+    show_envvar=True,
+)
+@click.option(
+    "--remote_profile",
+    "remote_profile",
+    help="Tune GDAL for assets read over HTTP: merged and multiplexed range requests, VSI caches, "
+    "no directory listing, and a block cache sized for the block layout of the scene",
+    is_flag=True,
+    default=False,
+    envvar="MAKE_INFERENCE_REMOTE_PROFILE",
+    show_envvar=True,
+)
+@click.option(
+    "--report_requests",
+    "report_requests",
+    help="Count the HTTP requests sent by GDAL and the bytes they fetch, logged for every scene",
+    is_flag=True,
+    default=False,
+    envvar="MAKE_INFERENCE_REPORT_REQUESTS",
+    show_envvar=True,
+)
+@click.option(
+    "--validity_prepass/--no_validity_prepass",
+    "validity_prepass",
+    help="Drop the windows without data from a low-resolution read of the reference band, "
+    "before any strip is read",
+    default=True,
+    show_default=True,
+)
+@click.option(
+    "--cloud_threshold",
+    "cloud_threshold",
+    help="Skip the windows whose cloudy fraction, from the SCL or cloud probability asset of the item, "
+    "is above this value, and set them to the cloud class (11). Disabled by default",
+    type=click.FloatRange(min=0, max=1),
+    default=None,
+)
+@click.option(
+    "--checkpoint",
+    "checkpoint",
+    help="Save the classified windows of a scene to {item id}_classified.checkpoint.npz in the working "
+    "directory, and resume from it when the same item is classified again with the same model",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--checkpoint_interval",
+    "checkpoint_interval",
+    help="Seconds between two checkpoint saves",
+    type=click.IntRange(min=1),
+    default=60,
+    show_default=True,
+)
+@click.option(
+    "--prediction_cache",
+    "prediction_cache",
+    help="SQLite file caching the class of every window by model and window content, so that windows "
+    "already classified by the same model, in any scene or run, never reach the model again "
+    "(window engine only, not with --probability)",
+    type=click.Path(dir_okay=False),
+    default=None,
+    envvar="MAKE_INFERENCE_PREDICTION_CACHE",
+    show_envvar=True,
+)
+@click.option(
+    "--prediction_cache_entries",
+    "prediction_cache_entries",
+    help="Maximum number of windows in the prediction cache, the least recently used ones are evicted",
+    type=click.IntRange(min=1),
+    default=1_000_000,
+    show_default=True,
+)
+@click.option(
+    "--workers",
+    "workers",
+    help="Number of worker processes classifying stripes of a scene in parallel, each with its own "
+    "dataset handles and model session (using one intra-op thread unless --intra_op_threads is set). "
+    "1 classifies in the main process",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    envvar="MAKE_INFERENCE_WORKERS",
+    show_envvar=True,
+)
+@click.option(
+    "--queue_depth",
+    "queue_depth",
+    help="Maximum number of strips read ahead of the model, each read into one of queue_depth + 1 reused buffers",
+    type=click.IntRange(min=1),
+    default=2,
+    show_default=True,
+)
+@click.option(
+    "--strip_rows",
+    "strip_rows",
+    help="Rows read per band in a single strip, defaults to the source block height",
+    type=click.IntRange(min=1),
+    default=None,
+)
+@click.option(
+    "--output_mode",
+    "output_mode",
+    help="Stream classified tiles to disk while predicting, keep the whole scene in memory, or write "
+    "one pixel per window on the grid of the windows, with the stride as pixel size",
+    type=click.Choice(["stream", "canvas", "grid"]),
+    default="stream",
+    show_default=True,
+)
+@click.option(
+    "--probability",
+    "probability",
+    help="Write the probability of the class of every window as a second band, scaled to 0-255 "
+    "(--output_mode grid only)",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--engine",
+    "engine",
+    help="Classify each window separately, or run a fully-convolutional model over whole strips. "
+    "Without overlap, the windows of a model with 'same' padding, whose scores depend on the "
+    "neighbouring windows in a strip, are classified separately so the classes match the window engine",
+    type=click.Choice(["window", "fcn"]),
+    default="window",
+    show_default=True,
+)
+@click.option(
+    "--stride",
+    "stride",
+    help="Distance in pixels between two windows, smaller than the window size for overlapping predictions",
+    type=click.IntRange(min=1, max=64),
+    default=64,
+    show_default=True,
+)
+@click.option(
+    "--model",
+    "model_path",
+    help="Path to the ONNX model",
+    type=click.Path(exists=True, dir_okay=False),
+    default=DEFAULT_MODEL_PATH,
+    envvar="MAKE_INFERENCE_MODEL",
+    show_envvar=True,
+)
+@click.option(
+    "--model_variant",
+    "model_variant",
+    help="Precision of the model, the quantized variants are read next to --model as <name>_<variant>.onnx",
+    type=click.Choice(MODEL_VARIANTS),
+    default="fp32",
+    show_default=True,
+    envvar="MAKE_INFERENCE_MODEL_VARIANT",
+    show_envvar=True,
+)
+@click.option(
+    "--intra_op_threads",
+    "intra_op_threads",
+    help="Threads used inside a model operator, 0 uses all the cores",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    envvar="MAKE_INFERENCE_INTRA_OP_THREADS",
+    show_envvar=True,
+)
+@click.option(
+    "--inter_op_threads",
+    "inter_op_threads",
+    help="Threads running independent model operators with the parallel execution mode, 0 uses the default",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    envvar="MAKE_INFERENCE_INTER_OP_THREADS",
+    show_envvar=True,
+)
+@click.option(
+    "--graph_optimization",
+    "graph_optimization",
+    help="onnxruntime graph optimization level",
+    type=click.Choice(list(GRAPH_OPTIMIZATION_LEVELS)),
+    default="all",
+    show_default=True,
+    envvar="MAKE_INFERENCE_GRAPH_OPTIMIZATION",
+    show_envvar=True,
+)
+@click.option(
+    "--execution_mode",
+    "execution_mode",
+    help="Run the model operators one after the other, or independent ones in parallel",
+    type=click.Choice(list(EXECUTION_MODES)),
+    default="sequential",
+    show_default=True,
+    envvar="MAKE_INFERENCE_EXECUTION_MODE",
+    show_envvar=True,
+)
+@click.option(
+    "--memory_arena/--no_memory_arena",
+    "memory_arena",
+    help="Keep the onnxruntime CPU memory arena, disabling it lowers peak memory",
+    default=True,
+    show_default=True,
+    envvar="MAKE_INFERENCE_MEMORY_ARENA",
+    show_envvar=True,
+)
+@click.option(
+    "--provider",
+    "providers",
+    help="onnxruntime execution provider in order of preference, can be repeated, the CPU provider is always used last",
+    multiple=True,
+    envvar="MAKE_INFERENCE_PROVIDERS",
+    show_envvar=True,
+)
+@click.option(
+    "--model_cache",
+    "model_cache",
+    help="Directory keeping the optimized models, so that later runs skip the graph optimization",
+    type=click.Path(file_okay=False),
+    default=DEFAULT_CACHE_DIR,
+    show_default=True,
+    envvar="MAKE_INFERENCE_MODEL_CACHE",
+    show_envvar=True,
+)
+@click.option(
+    "--no_model_cache",
+    "no_model_cache",
+    help="Optimize the model at every startup without reading or writing the cache",
+    is_flag=True,
+    default=False,
 )
 @click.pass_context
 def run_inference(ctx, **params):
     # logger.info(os.path.dirname(os.path.abspath(".")))
 
-    if os.path.isdir(params["input_reference"]):
-        catalog = pystac.read_file(os.path.join(params["input_reference"], "catalog.json"))
-        item = next(catalog.get_items())
-        filtered_assets = item_filter_assets(item)
+    if params["bbox"] and params["aoi"]:
+        raise click.UsageError("--bbox and --aoi are mutually exclusive")
+    with Inference(params) as inference:
+        inference.run(params)
+
+
+# Options of the model session, shared by all the make-inference commands
+SESSION_OPTIONS = [
+    "model_path",
+    "model_variant",
+    "intra_op_threads",
+    "inter_op_threads",
+    "graph_optimization",
+    "execution_mode",
+    "memory_arena",
+    "providers",
+    "model_cache",
+    "no_model_cache",
+]
+
+
+def model_session_kwargs(params):
+    """
+    Arguments of `create_session` from the SESSION_OPTIONS of the command line.
+    """
+    try:
+        model_path = variant_path(params["model_path"], params["model_variant"])
+    except FileNotFoundError as e:
+        raise click.BadParameter(str(e), param_hint="--model_variant")
+    return dict(
+        model_path=model_path,
+        intra_op_threads=params["intra_op_threads"],
+        inter_op_threads=params["inter_op_threads"],
+        graph_optimization=params["graph_optimization"],
+        execution_mode=params["execution_mode"],
+        memory_arena=params["memory_arena"],
+        providers=params["providers"],
+        cache_dir=None if params["no_model_cache"] else params["model_cache"],
+    )
+
+
+# Options a job of `make-inference serve` can set, the other ones configure the service
+JOB_OPTIONS = [
+    "bbox",
+    "aoi",
+    "batch_size",
+    "validity_prepass",
+    "cloud_threshold",
+    "checkpoint",
+    "checkpoint_interval",
+    "queue_depth",
+    "strip_rows",
+    "output_mode",
+    "probability",
+    "stride",
+]
+
+
+class Inference:
+    """
+    The model session, reader threads or worker processes, and prediction cache of make-inference.
+
+    They are created once from the command line parameters and shared by all the
+    scenes of the runs, so `make-inference serve` keeps them warm between jobs.
+    Runs may be called from several threads at once.
+    """
 
-    else:
-        item = pystac.read_file(params["input_reference"])
-        filtered_assets = item_filter_assets(item)
-   
-    logger.info(f"Read {item.get_self_href()}")
     window_size = 64
-    logger.info(f"Item assets keys are: {item.get_assets().keys()} \n\nFiltered assets: {filtered_assets.keys()}")
-    for key, asset_href in filtered_assets.items():
-        updated_asset_href = resize_and_convert_to_cog(key, asset_href)
-        filtered_assets[key] = updated_asset_href
+
+    def __init__(self, params):
+        # GDAL settings of the process, set from the main thread to apply to all the reader threads
+        self.report_requests = params["report_requests"]
+        if self.report_requests:
+            count_requests()
+        if params["remote_profile"]:
+            apply_remote_profile()
+            logger.info("Reading the assets with the remote read profile")
+        session_kwargs = model_session_kwargs(params)
+        model_path = session_kwargs["model_path"]
+        self.model_path = model_path
+        self.engine = params["engine"]
+        self.session = create_session(**session_kwargs)
+        self.net_stride = None
+        self.independent_windows = True
+        if self.engine == "fcn":
+            if not is_fully_convolutional(self.session):
+                raise click.UsageError(f"{model_path} is not a fully-convolutional model, use --engine window")
+            self.net_stride = network_stride(
+                self.session,
+                self.session.get_inputs()[0].name,
+                self.session.get_outputs()[0].name,
+                self.window_size,
+            )
+            self.independent_windows = independent_windows(
+                self.session,
+                self.session.get_inputs()[0].name,
+                self.session.get_outputs()[0].name,
+                self.window_size,
+                self.net_stride,
+            )
+        self.check_params(params)
+
+        self.prediction_cache = params["prediction_cache"]
+        if self.prediction_cache and self.engine == "fcn":
+            logger.warning("The prediction cache is not used with --engine fcn, where windows depend on their neighbours")
+            self.prediction_cache = None
+        self.model_hash = file_hash(model_path) if params["checkpoint"] or self.prediction_cache else None
+        cache_kwargs = None
+        if self.prediction_cache:
+            cache_kwargs = dict(
+                path=self.prediction_cache,
+                model_hash=self.model_hash,
+                max_entries=params["prediction_cache_entries"],
+            )
+
+        self.cache = None
+        if params["workers"] > 1:
+            self.session = None
+            session_kwargs["intra_op_threads"] = params["intra_op_threads"] or 1
+            self.pool = StripePool(
+                params["workers"],
+                session_kwargs,
+                cache_kwargs,
+                remote_profile=params["remote_profile"],
+                report_requests=params["report_requests"],
+            )
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=params["readers"], thread_name_prefix="reader")
+            self.cache = PredictionCache(**cache_kwargs) if cache_kwargs else None
+
+    def check_params(self, params):
+        """Checks the parameters of a run against the engine."""
+        if self.net_stride and params["stride"] % self.net_stride:
+            raise click.UsageError(f"--stride must be a multiple of the model stride ({self.net_stride})")
+        if params["probability"] and params["output_mode"] != "grid":
+            raise click.UsageError("--probability is only written with --output_mode grid")
+
+    def strip_stride(self, params):
+        """
+        Model stride given to `classify_item`, None to classify the windows in batches.
+
+        Without overlap, the windows of a fully-convolutional model whose windows
+        depend on their neighbours in a strip are classified one by one, so the
+        classes are the ones of the window engine.
+        """
+        if self.net_stride and params["stride"] == self.window_size and not self.independent_windows:
+            logger.info("The scores of the model depend on the neighbouring windows, classifying the windows separately")
+            return None
+        return self.net_stride
+
+    def run(self, params, output_dir="."):
+        """
+        Classifies the items of `params["input_reference"]` into a STAC Catalog.
+
+        Parameters:
+        - params: command line parameters, the ones of JOB_OPTIONS may differ between runs
+        - output_dir: directory of the outputs and of the catalog
+
+        Returns:
+        - the path of the catalog, and the number of classified scenes
+        """
+        self.check_params(params)
+        if params["probability"] and self.prediction_cache:
+            logger.warning("The prediction cache is not used with --probability, it only keeps the classes")
+        aoi = read_aoi(params["aoi"], params["bbox"]) if params["bbox"] or params["aoi"] else None
+        if params["checkpoint"] and self.model_hash is None:
+            self.model_hash = file_hash(self.model_path)
+        os.makedirs(output_dir, exist_ok=True)
+
+        net_stride = self.strip_stride(params)
+        results = []
+        for item in read_items(params["input_reference"]):
+            raster_bands = classify_item(
+                item,
+                self.session,
+                net_stride,
+                self.pool,
+                self.window_size,
+                dict(params, prediction_cache=self.prediction_cache),
+                aoi=aoi,
+                model_hash=self.model_hash,
+                cache=self.cache,
+                output_dir=output_dir,
+            )
+            if raster_bands is not None:
+                results.append((item, raster_bands))
+
+        cat = create_stac_catalog(results, output_dir)
+        logger.info(f"Done! Classified {len(results)} scenes")
+        return cat.get_self_href(), len(results)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.pool.__exit__(*exc)
+        if self.cache is not None:
+            self.cache.close()
+        if self.report_requests:
+            stop_counting()
+
+
+def fetched_requests(pool):
+    """HTTP requests sent and bytes fetched by this process, and by the workers of a StripePool."""
+    requests, fetched = request_counters()
+    if isinstance(pool, StripePool):
+        pool_requests, pool_fetched = pool.request_counters()
+        requests, fetched = requests + pool_requests, fetched + pool_fetched
+    return requests, fetched
+
+
+def classify_item(
+    item, session, net_stride, pool, window_size, params, aoi=None, model_hash=None, cache=None, output_dir="."
+):
+    """
+    Classifies a Sentinel-2 STAC Item and saves the COG outputs in `output_dir`.
+
+    Parameters:
+    - item: the STAC Item to classify
+    - session: onnxruntime session running the model, None when `pool` is a StripePool
+    - net_stride: stride of the fully-convolutional model, None for the window engine
+    - pool: reader threads given to `prefetch`, or the StripePool classifying the stripes
+    - window_size: size of the windows classified by the model
+    - params: command line parameters
+    - aoi: GeoJSON geometries of the area of interest, as returned by `read_aoi`
+    - model_hash: hash of the model file, identifying the checkpoints of the scene
+    - cache: PredictionCache used in this process, the StripePool workers open their own
+    - output_dir: directory of the COG outputs and of the checkpoint
+
+    Returns:
+    - the raster:bands statistics of the classification, None when the item is
+      outside the area of interest
+    """
+    filtered_assets = item_filter_assets(item)
+
+    logger.info(f"Read {item.get_self_href()}")
+    logger.info(f"Item assets keys are: {item.assets.keys()} \n\nFiltered assets: {filtered_assets.keys()}")
     ### Open the tif file
-    srcs, referenced_src, meta = asset_reader(filtered_assets)
-    prediction = np.full(
-        (
-            referenced_src.height,
-            referenced_src.width,
-        ),
-        np.nan,
-        dtype=np.float32,  # Use a floating-point data type
-    )  # create the empty array
-    windows = sliding((referenced_src.height, referenced_src.width), window_size)
+    start_requests = fetched_requests(pool)
+    vrt, referenced_src, meta = stack_assets(filtered_assets, threads=params["gdal_threads"])
 
-    tqdm_loop = tqdm(
-        windows,
-        total=len(windows),
-        desc=f"Predicting",
+    windows = sliding((referenced_src.height, referenced_src.width), window_size, step_size=params["stride"])
+    strip_rows = params["strip_rows"] or strip_height(referenced_src, window_size)
+    if params["remote_profile"] and not isinstance(pool, StripePool):
+        # The workers of a StripePool size their own cache
+        raise_block_cache(block_cache_size(vrt, params["readers"]))
+    checkpoint = None
+    if params["checkpoint"]:
+        fingerprint = WindowCheckpoint.fingerprint_of(
+            item=item.id,
+            model=model_hash,
+            engine=params["engine"],
+            window_size=window_size,
+            stride=params["stride"],
+            shape=[referenced_src.height, referenced_src.width],
+            # Options changing the classes kept for a window
+            cloud_threshold=params["cloud_threshold"],
+            validity_prepass=params["validity_prepass"],
+            probability=params["probability"],
+        )
+        checkpoint = WindowCheckpoint(
+            os.path.join(output_dir, f"{item.id}_classified.checkpoint.npz"),
+            windows,
+            fingerprint,
+            interval=params["checkpoint_interval"],
+            probability=params["probability"],
+        )
+    offset = (0, 0)
+    if aoi is not None:
+        # Only the windows touching the area are read, and the output is cropped to them
+        inside = aoi_windows(aoi, referenced_src, windows, window_size)
+        windows = [window for window, is_inside in zip(windows, inside) if is_inside]
+        if not windows:
+            logger.warning(f"Item {item.id} does not intersect the area of interest, skipping it")
+            referenced_src.close()
+            return None
+        crop = rasterio.windows.union(*windows)
+        meta = crop_meta(meta, crop)
+        offset = (crop.row_off, crop.col_off)
+        logger.info(f"Cropping the output to {crop} for the area of interest")
+    if params["validity_prepass"]:
+        # Empty windows are never read nor classified, the writer leaves them as no-data
+        valid = window_validity(referenced_src, windows, window_size)
+        logger.info(f"Skipping {len(windows) - valid.sum()} of {len(windows)} windows without data")
+        windows = [window for window, is_valid in zip(windows, valid) if is_valid]
+    cloudy_windows = []
+    if params["cloud_threshold"] is not None:
+        cloud_href, cloud_kind = item_cloud_asset(item)
+        if cloud_href is None:
+            logger.warning(f"Item {item.id} has no cloud mask asset, classifying all the windows")
+        else:
+            fraction = window_cloud_fraction(cloud_href, cloud_kind, referenced_src, windows, window_size)
+            cloudy = fraction > params["cloud_threshold"]
+            logger.info(f"Skipping {cloudy.sum()} of {len(windows)} cloudy windows")
+            cloudy_windows = [window for window, is_cloudy in zip(windows, cloudy) if is_cloudy]
+            windows = [window for window, is_cloudy in zip(windows, cloudy) if not is_cloudy]
+    known_windows = cloudy_windows
+    known_classes = window_values(len(cloudy_windows), CLOUD_CLASS, params["probability"])
+    if checkpoint is not None:
+        windows, restored_windows, restored_classes = checkpoint.split(windows)
+        known_windows = known_windows + restored_windows
+        known_classes = np.concatenate([known_classes, restored_classes])
+    referenced_src.close()
+    writer = prediction_writer(
+        params["output_mode"],
+        meta,
+        windows + known_windows,
+        os.path.join(output_dir, f"{item.id}_classified.tmp.tif"),
+        stride=params["stride"],
+        offset=offset,
+        window_size=window_size,
+        probability=params["probability"],
     )
-    model_path = os.path.join(
-        os.path.dirname(os.path.abspath(__file__)),
-        "model",
-        "model.onnx",
+
+    logger.info(f"Reading {len(windows)} windows in strips of {strip_rows} rows")
+
+    tqdm_loop = tqdm(
+        total=len(windows) + len(known_windows),
+        desc=f"Predicting {item.id}",
     )
-    session = ort.InferenceSession(model_path)
-    input_name = session.get_inputs()[0].name
-    output_name = session.get_outputs()[0].name
-
-    for i, window in enumerate(tqdm_loop):
-        arr_block = stack_separated_bands(window, srcs)  ## you must add ndwi
-        # print(arr_block.shape, prediction)
-        tqdm_loop.set_postfix(
-            ordered_dict={
-                "col_off": window.col_off,
-                "row_off": window.row_off,
-                "block shape": arr_block.shape,
-            }
+    if isinstance(pool, StripePool):
+        classified = pool.classify(
+            vrt,
+            strips(windows, strip_rows),
+            batch_size=params["batch_size"],
+            net_stride=net_stride,
+            probability=params["probability"],
+        )
+    else:
+        classified = classify_stripes(
+            vrt,
+            strips(windows, strip_rows),
+            session,
+            batch_size=params["batch_size"],
+            net_stride=net_stride,
+            queue_depth=params["queue_depth"],
+            pool=pool,
+            cache=cache,
+            probability=params["probability"],
+        )
+    # Hits and misses are counted in this process, or by the pool for its workers
+    cache_counters = pool if isinstance(pool, StripePool) else cache
+    if params["prediction_cache"]:
+        start_hits, start_misses = cache_counters.counters()
+    # Cloudy and restored windows are written as their strips come, not to hold rows of tiles in memory
+    for strip_windows, classes in interleave_strips(classified, known_windows, known_classes, strip_rows):
+        tqdm_loop.set_postfix(ordered_dict={"row_off": strip_windows[0].row_off})
+        writer.write(strip_windows, classes)
+        if checkpoint is not None:
+            checkpoint.update(strip_windows, classes)
+        tqdm_loop.update(len(strip_windows))
+    tqdm_loop.close()
+    if params["prediction_cache"]:
+        hits, misses = cache_counters.counters()
+        logger.info(f"Prediction cache: {hits - start_hits} hits, {misses - start_misses} misses")
+    requests, fetched = fetched_requests(pool)
+    if requests > start_requests[0]:
+        logger.info(
+            f"Fetched {(fetched - start_requests[1]) / 2**20:.1f} MB in {requests - start_requests[0]} HTTP requests"
         )
 
-        prediction_block = predict(arr_block, session, input_name, output_name)
-        prediction[
-            window.row_off : window.row_off + window.height,
-            window.col_off : window.col_off + window.width,
-        ] = prediction_block
-
-        # Save prediction as a COG tif image and provide STAC objs for that
+    # Save prediction as a COG tif image and provide STAC objs for that
     logger.info(f"Saving segmentation result to {item.id}_classified.tif")
-    prediction_block_raster = GeoTensor(
-        prediction,
-        transform=meta["transform"],
-        fill_value_default=None,
-        crs=meta["crs"],
+    if checkpoint is not None:
+        checkpoint.save()
+    writer.save(
+        os.path.join(output_dir, f"{item.id}_classified.tif"),
+        os.path.join(output_dir, f"overview-{item.id}_classified.tif"),
     )
-    save_prediction(prediction_block_raster.values, f"{item.id}_classified.tif", meta)
-    save_overview(prediction_block_raster.values, f"overview-{item.id}_classified.tif", meta)
-
-    create_stac_catalog(item)
-    del arr_block, prediction
-    for file in os.listdir():
-        if file.endswith("tiff") or file.endswith("tif") or file.endswith("jp2"):
-            os.remove(file)
-    logger.info("Done!")
+    if checkpoint is not None:
+        checkpoint.remove()
+    return writer.stats.raster_bands()
 
 
 def main():
-    run_inference()
+    if sys.argv[1:2] == ["serve"]:
+        from .serve import serve
+
+        serve(sys.argv[2:], prog_name="make-inference serve")
+    elif sys.argv[1:2] == ["tiles"]:
+        from .tiles import tiles
+
+        tiles(sys.argv[2:], prog_name="make-inference tiles")
+    else:
+        run_inference()
 
 
 if __name__ == "__main__":
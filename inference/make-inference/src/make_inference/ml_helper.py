@@ -1,13 +1,27 @@
 from loguru import logger
 import os
+import json
 from shutil import move
 import rasterio
+import rasterio.shutil
 import pystac
+import pystac.extensions.eo
+from pystac.stac_io import StacIO
 from rio_stac.stac import create_stac_item
-from rasterio.warp import Resampling
+from rasterio.warp import Resampling, transform_geom
 from rasterio.windows import Window
-from planetary_computer import sign
+from rasterio.vrt import WarpedVRT
+from rasterio.transform import Affine
+from rasterio.features import rasterize
+from urllib.parse import urlparse
+from xml.etree import ElementTree
+from planetary_computer import sign_url
 from typing import Dict, List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import nullcontext
+import queue
+import threading
 import pystac
 import warnings
 import math
@@ -15,6 +29,54 @@ import numpy as np
 
 warnings.filterwarnings("ignore")
 
+# Class written for windows without any valid pixel
+NO_DATA_CLASS = 10
+# Windows skipped as cloudy
+CLOUD_CLASS = 11
+
+# Cloud mask assets of Sentinel-2 L2A items: the scene classification layer, or a cloud probability in %
+CLOUD_ASSETS = {
+    "SCL": "scl",
+    "scl": "scl",
+    "CLD": "probability",
+    "cloud": "probability",
+}
+# Scene classification values treated as clouds: cloud shadows, medium and high probability clouds, thin cirrus
+SCL_CLOUD_CLASSES = [3, 8, 9, 10]
+# Cloud probability from which a pixel is cloudy
+CLOUD_PROBABILITY = 50
+
+# Max class probabilities are written as uint8, 255 for a probability of 1. As they
+# are at least 1 / 10 (26), NO_DATA_CLASS is also the no-data value of that band
+PROBABILITY_SCALE = 255
+
+# Reflectances are stored as uint16 digital numbers, divided by this scale
+REFLECTANCE_SCALE = 10000.0
+
+# GDAL virtual file systems of the cloud storage hrefs
+VSI_SCHEMES = {"s3": "vsis3", "gs": "vsigs", "az": "vsiaz"}
+
+# Numpy types of the model outputs bound by `BatchBuffers`
+OUTPUT_TYPES = {
+    "tensor(float)": np.float32,
+    "tensor(float16)": np.float16,
+    "tensor(double)": np.float64,
+}
+
+CLASS_COLORMAP = {
+    0: (34, 139, 34, 255),  # AnnualCrop: Forest Green
+    1: (0, 100, 0, 255),  # Forest: Dark Green
+    2: (144, 238, 144, 255),  # HerbaceousVegetation: Light Green
+    3: (128, 128, 128, 255),  # Highway: Gray
+    4: (169, 169, 169, 255),  # Industrial: Dark Gray
+    5: (85, 107, 47, 255),  # Pasture: Olive Green
+    6: (60, 179, 113, 255),  # PermanentCrop: Medium Sea Green
+    7: (139, 69, 19, 255),  # Residential: Saddle Brown
+    8: (30, 144, 255, 255),  # River: Dodger Blue
+    9: (0, 0, 255, 255),  # SeaLake: Blue
+    11: (255, 255, 255, 255),  # Cloud: White
+}
+
 
 def _get_stats(arr: np.ma.MaskedArray) -> Dict:
     """Calculate array statistics."""
@@ -38,6 +100,81 @@ def _get_stats(arr: np.ma.MaskedArray) -> Dict:
     }
 
 
+class ClassStatistics:
+    """
+    Running statistics of a classification raster, accumulated while it is written.
+
+    Keeps one pixel count per uint8 value and band with `np.bincount`, from which
+    the `raster:bands` statistics and histogram are derived without reading the
+    output back. Pixels never written are counted as no-data.
+    """
+
+    def __init__(self, height, width, nodata=NO_DATA_CLASS, scales=(1.0,)):
+        self.size = height * width
+        self.nodata = nodata
+        self.scales = scales
+        self.counts = np.zeros((len(scales), 256), dtype=np.int64)
+
+    def update(self, windows, classes):
+        """
+        Parameters:
+        - windows (list): Windows written, as rasterio.windows.Window objects.
+        - classes (np.ndarray or int): Value of each window, shape (len(windows),) for a
+          single band or (len(windows), bands), or a single class for all of them.
+        """
+        values = np.broadcast_to(classes, (len(windows),) + np.shape(classes)[1:]).astype(np.uint8)
+        values = values.reshape(len(windows), -1)
+        areas = [window.height * window.width for window in windows]
+        for band, band_values in enumerate(values.T):
+            self.counts[band] += np.bincount(band_values, weights=areas, minlength=256).astype(np.int64)
+
+    def _get_stats(self, band=0) -> Dict:
+        counts = self.counts[band].copy()
+        counts[self.nodata] = 0
+        valid = int(counts.sum())
+        values = np.arange(256)
+        if valid:
+            present = np.flatnonzero(counts)
+            mean = float((values * counts).sum() / valid)
+            statistics = {
+                "mean": mean,
+                "minimum": int(present.min()),
+                "maximum": int(present.max()),
+                "stddev": float(np.sqrt((counts * (values - mean) ** 2).sum() / valid)),
+            }
+        else:
+            statistics = {"mean": None, "minimum": None, "maximum": None, "stddev": None}
+        statistics["valid_percent"] = valid / float(self.size) * 100
+
+        # Same buckets as np.histogram(..., bins=np.arange(256)), the last bin is closed
+        buckets = counts[:255].copy()
+        buckets[-1] += counts[255]
+        return {
+            "statistics": statistics,
+            "histogram": {
+                "count": 256,
+                "min": 0.0,
+                "max": 255.0,
+                "buckets": buckets.tolist(),
+            },
+        }
+
+    def raster_bands(self) -> List[Dict]:
+        """`raster:bands` of the uint8 classification bands, as `get_raster_info` returns them."""
+        bands = []
+        for band, scale in enumerate(self.scales):
+            value = {
+                "data_type": "uint8",
+                "scale": scale,
+                "offset": 0.0,
+                "sampling": "area",
+                "nodata": float(self.nodata),
+            }
+            value.update(self._get_stats(band))
+            bands.append(value)
+        return bands
+
+
 def get_raster_info(
     src_dst,
     max_size: int = 1024,
@@ -91,14 +228,12 @@ def get_raster_info(
     return meta
 
 
-def generate_asset_overview(asset_in_key, target_dir):
+def generate_asset_overview(asset_in_key, target_dir, raster_bands=None):
     asset_out_key = f"{asset_in_key}"
-    raster_info = {
-        "raster:bands": get_raster_info(
-            rasterio.open(target_dir),
-            max_size=1024,
-        )
-    }
+    if raster_bands is None:
+        with rasterio.open(target_dir) as src:
+            raster_bands = get_raster_info(src, max_size=1024)
+    raster_info = {"raster:bands": raster_bands}
 
     return "overview-" + asset_in_key, pystac.asset.Asset(
         href=f"overview-{asset_out_key}_classified.tif",
@@ -109,14 +244,12 @@ def generate_asset_overview(asset_in_key, target_dir):
     )
 
 
-def generate_asset(asset_in_key, target_dir):
+def generate_asset(asset_in_key, target_dir, raster_bands=None):
     asset_out_key = f"{asset_in_key}"
-    raster_info = {
-        "raster:bands": get_raster_info(
-            rasterio.open(target_dir),
-            max_size=1024,
-        )
-    }
+    if raster_bands is None:
+        with rasterio.open(target_dir) as src:
+            raster_bands = get_raster_info(src, max_size=1024)
+    raster_info = {"raster:bands": raster_bands}
 
     return asset_in_key, pystac.asset.Asset(
         href=f"{asset_out_key}_classified.tif",
@@ -127,10 +260,14 @@ def generate_asset(asset_in_key, target_dir):
     )
 
 
-def to_stac(geotiff_path, item):
-    asset_key_image, asset_image = generate_asset(asset_in_key=item.id, target_dir=geotiff_path)
+def to_stac(geotiff_path, item, raster_bands=None):
+    asset_key_image, asset_image = generate_asset(
+        asset_in_key=item.id, target_dir=geotiff_path, raster_bands=raster_bands
+    )
 
-    asset_key_overview, asset_overview = generate_asset_overview(asset_in_key=item.id, target_dir=geotiff_path)
+    asset_key_overview, asset_overview = generate_asset_overview(
+        asset_in_key=item.id, target_dir=geotiff_path, raster_bands=raster_bands
+    )
 
     result_item = create_stac_item(
         id=f"{item.id}_classified",
@@ -158,29 +295,16 @@ def save_prediction(data, output_href, meta):
             "count": 1,
             "tiled": True,
             "compress": "deflate",
+            "num_threads": "ALL_CPUS",
             "interleave": "band",
             "nodata": 10,  # Setting nodata to -1 for this example
         }
     )
 
-    with rasterio.open(output_href, "w", **meta) as dst:
+    with rasterio.Env(GDAL_NUM_THREADS="ALL_CPUS"), rasterio.open(output_href, "w", **meta) as dst:
         dst.write(data, indexes=1)
         # Apply colormap to the data
-        dst.write_colormap(
-            1,
-            {
-                0: (34, 139, 34, 255),  # AnnualCrop: Forest Green
-                1: (0, 100, 0, 255),  # Forest: Dark Green
-                2: (144, 238, 144, 255),  # HerbaceousVegetation: Light Green
-                3: (128, 128, 128, 255),  # Highway: Gray
-                4: (169, 169, 169, 255),  # Industrial: Dark Gray
-                5: (85, 107, 47, 255),  # Pasture: Olive Green
-                6: (60, 179, 113, 255),  # PermanentCrop: Medium Sea Green
-                7: (139, 69, 19, 255),  # Residential: Saddle Brown
-                8: (30, 144, 255, 255),  # River: Dodger Blue
-                9: (0, 0, 255, 255),  # SeaLake: Blue
-            },
-        )
+        dst.write_colormap(1, CLASS_COLORMAP)
 
         cmap = dst.colormap(1)
         assert cmap[0] == (34, 139, 34, 255)
@@ -189,77 +313,146 @@ def save_prediction(data, output_href, meta):
         dst.update_tags(ns="rio_overview", resampling="nearest")
 
 
-def save_overview(data, output_href, meta):
-    mask = np.where(data == 0, 0, 255).astype(np.uint8)
-    meta.update(
-        {
-            "driver": "COG",
-            "dtype": "uint8",
-            "blockxsize": 512,
-            "blockysize": 512,
-            "count": 1,
-            "tiled": True,
-            "compress": "LZW",
-            "interleave": "band",
-            "nodata": 10,  # Setting nodata to 0 for this example
-        }
-    )
-    with rasterio.open(output_href, "w", **meta) as dst:
-        dst.write(data, indexes=1)
-        dst.write_colormap(
-            1,
-            {
-                0: (34, 139, 34, 255),  # AnnualCrop: Forest Green
-                1: (0, 100, 0, 255),  # Forest: Dark Green
-                2: (144, 238, 144, 255),  # HerbaceousVegetation: Light Green
-                3: (128, 128, 128, 255),  # Highway: Gray
-                4: (169, 169, 169, 255),  # Industrial: Dark Gray
-                5: (85, 107, 47, 255),  # Pasture: Olive Green
-                6: (60, 179, 113, 255),  # PermanentCrop: Medium Sea Green
-                7: (139, 69, 19, 255),  # Residential: Saddle Brown
-                8: (30, 144, 255, 255),  # River: Dodger Blue
-                9: (0, 0, 255, 255),  # SeaLake: Blue
-            },
-        )
-        cmap = dst.colormap(1)
-        assert cmap[0] == (34, 139, 34, 255)
-        dst.build_overviews([2, 4, 8, 16, 32, 64], Resampling.nearest)
-        dst.update_tags(ns="rio_overview", resampling="nearest")
+def derive_overview(prediction_href, output_href, max_size=1024):
+    """
+    Write the overview product from the pyramid of the classified COG.
+
+    The first overview level fitting in `max_size` pixels (or the coarsest one) is
+    copied as is, so the full resolution classification is not encoded again.
+    """
+    with rasterio.open(prediction_href) as src:
+        factors = src.overviews(1)
+        size = max(src.width, src.height)
+    levels = [i for i, factor in enumerate(factors) if size / factor <= max_size]
+    open_kwargs = {}
+    if factors:
+        open_kwargs["overview_level"] = levels[0] if levels else len(factors) - 1
+
+    with rasterio.Env(GDAL_NUM_THREADS="ALL_CPUS"):
+        with rasterio.open(prediction_href, **open_kwargs) as src:
+            rasterio.shutil.copy(
+                src,
+                output_href,
+                driver="COG",
+                blocksize=512,
+                compress="LZW",
+                overview_resampling="nearest",
+                num_threads="ALL_CPUS",
+            )
+
+
+def save_tiled_prediction(src_href, output_href, compress):
+    """
+    Convert a tiled classification GeoTIFF, with its colormap, to a COG.
+
+    The full resolution data is compressed and its overviews are built once,
+    on all CPUs, with nearest resampling.
+    """
+    with rasterio.Env(GDAL_NUM_THREADS="ALL_CPUS"):
+        with rasterio.open(src_href) as src:
+            rasterio.shutil.copy(
+                src,
+                output_href,
+                driver="COG",
+                blocksize=512,
+                compress=compress,
+                overview_resampling="nearest",
+                num_threads="ALL_CPUS",
+            )
+
+
+def create_stac_catalog(results, output_dir="."):
+    """
+    Saves a STAC Catalog with one classified item per input item.
 
+    Parameters:
+    - results: list of (input STAC Item, raster:bands statistics) tuples, the COG outputs
+      of every item being in `output_dir`
+    - output_dir: directory of the catalog, the working directory by default
 
-def create_stac_catalog(item: pystac.Item):
-    out_item = to_stac(f"{item.id}_classified.tif", item)
+    Returns:
+    - the saved pystac.Catalog
+    """
     logger.info(f"Creating a STAC Catalog for the segmentation result")
     cat = pystac.Catalog(id="catalog", description="segmentation result", title="segmentation result")
-    cat.add_items([out_item])
-    cat.normalize_and_save(root_href=os.getcwd(), catalog_type=pystac.CatalogType.SELF_CONTAINED)
-    move(
-        f"{item.id}_classified.tif",
-        os.path.join(out_item.id, f"{item.id}_classified.tif"),
-    )
-    move(
-        f"overview-{item.id}_classified.tif",
-        os.path.join(out_item.id, f"overview-{item.id}_classified.tif"),
-    )
+    out_items = []
+    for item, raster_bands in results:
+        out_items.append(
+            to_stac(os.path.join(output_dir, f"{item.id}_classified.tif"), item, raster_bands=raster_bands)
+        )
+    cat.add_items(out_items)
+    cat.normalize_and_save(root_href=os.path.abspath(output_dir), catalog_type=pystac.CatalogType.SELF_CONTAINED)
+    for (item, _), out_item in zip(results, out_items):
+        move(
+            os.path.join(output_dir, f"{item.id}_classified.tif"),
+            os.path.join(output_dir, out_item.id, f"{item.id}_classified.tif"),
+        )
+        move(
+            os.path.join(output_dir, f"overview-{item.id}_classified.tif"),
+            os.path.join(output_dir, out_item.id, f"overview-{item.id}_classified.tif"),
+        )
+    return cat
 
 
-def get_asset(item, common_name):
-    """Returns the asset of a STAC Item defined with its common band name"""
-    for key, asset in item.get_assets().items():
-        if not "data" in asset.to_dict()["roles"]:
-            continue
+def read_items(input_references):
+    """
+    Yields the STAC Items to classify.
+
+    Parameters:
+    - input_references: STAC Item urls, STAC Catalog urls, or directories holding a catalog.json
+
+    Yields:
+    - pystac.Item objects, all the items of a catalog in turn
+    """
+    seen = set()
+    for reference in input_references:
+        if os.path.isdir(reference):
+            reference = os.path.join(reference, "catalog.json")
+        stac_object = pystac.read_file(reference)
+        items = [stac_object] if isinstance(stac_object, pystac.Item) else stac_object.get_items(recursive=True)
+        for item in items:
+            if item.id in seen:
+                logger.warning(f"Skipping {item.get_self_href()}, item {item.id} is already classified")
+                continue
+            seen.add(item.id)
+            yield item
+
+
+def band_assets(item, bands):
+    """
+    Keys of the data assets of a STAC Item holding the given bands, in a single pass over the assets.
 
-        eo_asset = pystac.extensions.eo.AssetEOExtension(asset)
-        if not eo_asset.bands:
+    A band is held by the first data asset with an eo:bands name containing it.
+
+    Parameters:
+    - item: the STAC Item
+    - bands (list): common band names, e.g. "B01"
+
+    Returns:
+    - dict of the asset key of every band found
+    """
+    index = {}
+    # Assets of the item itself, `get_assets` copying each of them
+    for key, asset in item.assets.items():
+        if "data" not in (asset.roles or []):
             continue
-        for b in eo_asset.bands:
+        for b in pystac.extensions.eo.AssetEOExtension(asset).bands or []:
+            name = b.properties.get("name", "")
+            for band in bands:
+                if band in name and band not in index:
+                    index[band] = key
+    return index
 
-            if "name" in b.properties.keys() and common_name in b.properties["name"]:
-                signed_href = sign(asset.get_absolute_href())
-                return signed_href, key
 
+def get_asset(item, common_name):
+    """Returns the asset of a STAC Item defined with its common band name"""
+    key = band_assets(item, [common_name]).get(common_name)
+    if key is not None:
+        return sign_url(item.assets[key].get_absolute_href()), key
 
-def item_filter_assets(item):
+
+def item_filter_assets(item, sign=True):
+    """Hrefs of the band assets of a STAC Item, in the order of the model bands, signed unless `sign` is False."""
 
     bands = [
         
@@ -291,65 +484,176 @@ def item_filter_assets(item):
         # "B12",  #"swir22"
         
     ]
+    index = band_assets(item, bands)
     desirable_assets = {}
     for band in bands:
-
-        desirable_assets[band], key = get_asset(item, band)
+        assert band in index, f"Item has no {band} asset"
+        href = item.assets[index[band]].get_absolute_href()
+        desirable_assets[band] = sign_url(href) if sign else href
         print(f"Asset href {desirable_assets[band]} with common name {band} found")
     assert len(desirable_assets) > 0, "Item has no desirable asset"
     return desirable_assets
 
 
-def resize_and_convert_to_cog(key, asset_path, target_resolution=10):
-    output_file = f'./{key}.tif'
-    with rasterio.open(asset_path) as src:
-        src_transform = src.transform
-        if src_transform.a > target_resolution:
-            asset_path = output_file
-            # Calculate the new shape based on the target resolution
-            scale_x = int(src.width * (src.res[0] / target_resolution))
-            scale_y = int(src.height * (src.res[1] / target_resolution))
-            logger.info(f"Resizing {output_file} to {scale_x}x{scale_y}")
-            # Read and resample data
-            data = src.read(
-                out_shape=(src.count, int(scale_y), int(scale_x)),
-                resampling=Resampling.bilinear,
-            )
+def item_cloud_asset(item):
+    """
+    Returns the signed href and kind ("scl" or "probability") of the cloud mask asset
+    of a STAC Item, (None, None) when it has none.
+    """
+    for key, kind in CLOUD_ASSETS.items():
+        if key in item.assets:
+            href = sign_url(item.assets[key].get_absolute_href())
+            logger.info(f"Cloud mask asset {key} found")
+            return href, kind
+    return None, None
 
-            # Update the metadata for the transformed dataset
-            transform = src.transform * src.transform.scale((src.width / data.shape[-1]), (src.height / data.shape[-2]))
-            profile = src.profile
-            profile.update(
-                {
-                    "driver": "COG",
-                    "dtype": data.dtype,
-                    "height": data.shape[1],
-                    "width": data.shape[2],
-                    "transform": transform,
-                    "row_off": 1024,
-                    "col_off": 1024,
-                    "compress": "LZW",
-                    "interleave": "pixel",
-                }
-            )
 
-            # Write data directly to a COG file
-            with rasterio.open(output_file, "w", **profile) as dst:
-                dst.write(data)
+def gdal_path(href):
+    """
+    GDAL path of an asset href, e.g. /vsicurl/ for an http url, as rasterio opens it.
+
+    A raw url in a VRT would be downloaded whole by the HTTP driver. The path is
+    not taken from the file list of the dataset, which probes every side-car file
+    of a remote asset with a request.
+    """
+    scheme = urlparse(href).scheme
+    if scheme in ("http", "https", "ftp"):
+        return f"/vsicurl/{href}"
+    if scheme in VSI_SCHEMES:
+        return f"/{VSI_SCHEMES[scheme]}/{href.split('://', 1)[1]}"
+    return href
+
 
-    return asset_path
+def stack_assets(assets, resampling=Resampling.bilinear, threads="ALL_CPUS"):
+    """
+    Describe the band assets as a single VRT dataset on a common grid, the grid of the finest band.
+
+    Each asset is a band of the VRT. Coarser bands (20m/60m) are sources resampled
+    on the fly to that grid, so one windowed read returns the 10m-equivalent pixels
+    of all the bands, and GDAL fetches the blocks of every band itself, without the
+    whole band being resampled or written to disk. The bands of an item share their
+    CRS, a source is placed on the grid by its bounds.
 
+    Parameters:
+    - assets (dict): Band names mapped to asset hrefs, in the order of the bands.
+    - resampling (Resampling): Resampling of the coarser bands.
+    - threads (str): Threads decoding the blocks of a source read, as GDAL_NUM_THREADS.
 
-def asset_reader(assets):
-    srcs = {asset_key: rasterio.open(asset_href) for asset_key, asset_href in assets.items()}
-    print(srcs)
+    Returns:
+    - vrt (str): XML of the VRT, opened with `rasterio.open` by every reader.
+    - referenced_src: Dataset of the finest band, defining the grid, closed by the caller.
+    - meta (dict): Metadata of the reference grid.
+    """
+    natives = {asset_key: rasterio.open(asset_href) for asset_key, asset_href in assets.items()}
     # common bands order:
     # ['coastal', 'blue', 'green', 'red', 'rededge70', 'rededge74', 'rededge78', 'nir', 'nir08', 'nir09', 'cirrus', 'swir16', 'swir22']
-    referenced_src = next(iter(srcs.items()))[1]
+    referenced_src = min(natives.values(), key=lambda src: src.res[0])
 
+    vrt = ElementTree.Element(
+        "VRTDataset", rasterXSize=str(referenced_src.width), rasterYSize=str(referenced_src.height)
+    )
+    ElementTree.SubElement(vrt, "SRS").text = referenced_src.crs.to_wkt()
+    ElementTree.SubElement(vrt, "GeoTransform").text = ", ".join(map(repr, referenced_src.transform.to_gdal()))
+    resampled = []
+    for band, (asset_key, src) in enumerate(natives.items(), start=1):
+        vrt_band = ElementTree.SubElement(vrt, "VRTRasterBand", dataType="UInt16", band=str(band))
+        ElementTree.SubElement(vrt_band, "Description").text = asset_key
+        if src.nodata is not None:
+            ElementTree.SubElement(vrt_band, "NoDataValue").text = repr(src.nodata)
+        source = ElementTree.SubElement(vrt_band, "SimpleSource")
+        ElementTree.SubElement(source, "SourceFilename", relativeToVRT="0").text = gdal_path(src.name)
+        open_options = ElementTree.SubElement(source, "OpenOptions")
+        ElementTree.SubElement(open_options, "OOI", key="NUM_THREADS").text = str(threads)
+        ElementTree.SubElement(source, "SourceBand").text = "1"
+        # Sources are opened by the first read, and the block layout is known without opening them
+        block_height, block_width = src.block_shapes[0]
+        ElementTree.SubElement(
+            source,
+            "SourceProperties",
+            RasterXSize=str(src.width),
+            RasterYSize=str(src.height),
+            DataType="UInt16",
+            BlockXSize=str(block_width),
+            BlockYSize=str(block_height),
+        )
+        ElementTree.SubElement(source, "SrcRect", xOff="0", yOff="0", xSize=str(src.width), ySize=str(src.height))
+        col_off, row_off = ~referenced_src.transform * (src.bounds.left, src.bounds.top)
+        col_end, row_end = ~referenced_src.transform * (src.bounds.right, src.bounds.bottom)
+        ElementTree.SubElement(
+            source,
+            "DstRect",
+            xOff=repr(col_off),
+            yOff=repr(row_off),
+            xSize=repr(col_end - col_off),
+            ySize=repr(row_end - row_off),
+        )
+        if (src.width, src.height, src.transform) != (
+            referenced_src.width,
+            referenced_src.height,
+            referenced_src.transform,
+        ):
+            source.set("resampling", resampling.name)
+            resampled.append(asset_key)
+    logger.debug(f"Stacked {list(natives)}, resampling {resampled}")
+
+    for src in natives.values():
+        if src is not referenced_src:
+            src.close()
     meta = referenced_src.meta.copy()
 
-    return srcs, referenced_src, meta
+    return ElementTree.tostring(vrt, encoding="unicode"), referenced_src, meta
+
+
+def prefetch(vrt, jobs, read_fn, readers=2, queue_depth=256, pool=None):
+    """
+    Read jobs ahead of the consumer on a pool of reader threads.
+
+    Every reader thread opens its own handle of the dataset, since rasterio
+    datasets must not be shared between threads. At most `queue_depth`
+    jobs are in flight, so the consumer (the ONNX session) runs while the next
+    blocks are being read.
+
+    Parameters:
+    - vrt (str): Dataset read, e.g. the VRT of `stack_assets`.
+    - jobs (list): Items passed to `read_fn`, e.g. rasterio.windows.Window objects.
+    - read_fn (callable): Called as `read_fn(job, src)` on a reader thread.
+    - readers (int): Number of reader threads, when no `pool` is given.
+    - queue_depth (int): Maximum number of jobs read ahead of the consumer.
+    - pool (ThreadPoolExecutor): Reader threads kept across calls, e.g. across scenes.
+      The handles opened for `vrt` are still closed when the call ends.
+
+    Yields:
+    - (job, result) tuples, in the order of `jobs`.
+    """
+    local = threading.local()
+    opened = []
+    lock = threading.Lock()
+
+    def read(job):
+        if not hasattr(local, "src"):
+            local.src = rasterio.open(vrt)
+            with lock:
+                opened.append(local.src)
+        return job, read_fn(job, local.src)
+
+    pending = deque()
+    try:
+        with nullcontext(pool) if pool else ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix="reader"
+        ) as executor:
+            for job in jobs:
+                pending.append(executor.submit(read, job))
+                if len(pending) >= queue_depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        # A shared pool is not shut down, wait for the reads still running
+        wait(pending)
+        for src in opened:
+            src.close()
 
 
 def sliding(shape, window_size, step_size=None, fixed=True):
@@ -378,27 +682,353 @@ def sliding(shape, window_size, step_size=None, fixed=True):
     return windows
 
 
-def stack_separated_bands(window, srcs, block_shape=(12, 64, 64)):
+def stack_separated_bands(window, src, block_shape=(12, 64, 64)):
     """
-    Stack specified bands from raster sources into a numpy array block.
+    Stack the bands of a window into a numpy array block.
 
     Parameters:
     - window (rasterio.windows.Window): Window of pixels to read.
-    - srcs (dict): Dictionary containing raster sources with band names as keys.
+    - src: Dataset stacking the bands, opened from the VRT of `stack_assets`.
 
     Returns:
     - block (np.ndarray): Stacked array of bands and derived indices.
       Shape will be (num_bands + num_indices, window.height, window.width).
     """
-    bands = srcs.keys()
-
     block = np.empty(block_shape, dtype=np.uint16)
-    for i, band_name in enumerate(bands):
-        block[i, :, :] = srcs[band_name].read(1, window=window)
+    src.read(window=window, out=block)
 
     return block
 
 
+def window_validity(src, windows, window_size, cells=8):
+    """
+    Flag the windows holding data from a low-resolution read of a single band.
+
+    The band is read once for the whole scene with `average` resampling at
+    `cells` x `cells` pixels per window, so GDAL serves it from an overview when
+    one is available. An averaged pixel is zero only when all the pixels it
+    covers are zero. The mask is then grown by one low-resolution pixel, since
+    the coarser bands resampled on the reference grid spill a few pixels past
+    its data, so a window is flagged empty only when none of the bands has data.
+
+    Parameters:
+    - src: Opened dataset on the grid of the windows, usually the reference band.
+    - windows (list): rasterio.windows.Window objects, as returned by `sliding`.
+    - window_size (int): Size of the windows.
+    - cells (int): Pixels per window side in the low-resolution read.
+
+    Returns:
+    - valid (np.ndarray): Boolean array, True for windows holding data.
+    """
+    height, width, _ = coarse_grid(src, window_size, cells)
+    coarse = src.read(1, out_shape=(height, width), resampling=Resampling.average) != 0
+    padded = np.pad(coarse, 1)
+    coarse = np.zeros_like(coarse)
+    for dy in range(3):
+        for dx in range(3):
+            coarse |= padded[dy : dy + height, dx : dx + width]
+    return reduce_windows(coarse, src, windows, np.any)
+
+
+def window_cloud_fraction(href, kind, src, windows, window_size, cells=8):
+    """
+    Fraction of cloudy pixels of every window, from a low-resolution read of the cloud mask.
+
+    The mask is warped with `nearest` resampling on a grid of `cells` x `cells`
+    pixels per window covering `src`, so only a small overview-level read is done.
+
+    Parameters:
+    - href: Cloud mask asset, as returned by `item_cloud_asset`.
+    - kind: "scl" for a scene classification, "probability" for a cloud probability in %.
+    - src: Opened dataset on the grid of the windows, usually the reference band.
+    - windows (list): rasterio.windows.Window objects, as returned by `sliding`.
+    - window_size (int): Size of the windows.
+    - cells (int): Pixels per window side in the low-resolution read.
+
+    Returns:
+    - fraction (np.ndarray): Cloudy fraction of every window, between 0 and 1.
+    """
+    height, width, transform = coarse_grid(src, window_size, cells)
+    with rasterio.open(href) as mask_src, WarpedVRT(
+        mask_src,
+        crs=src.crs,
+        transform=transform,
+        width=width,
+        height=height,
+        resampling=Resampling.nearest,
+    ) as vrt:
+        mask = vrt.read(1)
+    cloudy = np.isin(mask, SCL_CLOUD_CLASSES) if kind == "scl" else mask >= CLOUD_PROBABILITY
+    return reduce_windows(cloudy, src, windows, np.mean).astype(np.float32)
+
+
+def read_aoi(aoi=None, bbox=None):
+    """
+    Returns the area of interest as a list of GeoJSON geometries in EPSG:4326.
+
+    Parameters:
+    - aoi: Path or url to a GeoJSON geometry, Feature or FeatureCollection.
+    - bbox: (min lon, min lat, max lon, max lat) tuple.
+    """
+    if bbox:
+        min_x, min_y, max_x, max_y = bbox
+        return [
+            {
+                "type": "Polygon",
+                "coordinates": [[[min_x, min_y], [max_x, min_y], [max_x, max_y], [min_x, max_y], [min_x, min_y]]],
+            }
+        ]
+
+    geojson = json.loads(StacIO.default().read_text(aoi))
+    if geojson["type"] == "FeatureCollection":
+        return [feature["geometry"] for feature in geojson["features"]]
+    if geojson["type"] == "Feature":
+        return [geojson["geometry"]]
+    return [geojson]
+
+
+def aoi_windows(geometries, src, windows, window_size, cells=8):
+    """
+    Flag the windows intersecting the area of interest.
+
+    The geometries are projected in the raster CRS and rasterized with
+    `all_touched` on a grid of `cells` x `cells` pixels per window, so any window
+    touched by the area is kept.
+
+    Parameters:
+    - geometries (list): GeoJSON geometries in EPSG:4326, as returned by `read_aoi`.
+    - src: Opened dataset on the grid of the windows, usually the reference band.
+    - windows (list): rasterio.windows.Window objects, as returned by `sliding`.
+    - window_size (int): Size of the windows.
+    - cells (int): Pixels per window side of the rasterized area.
+
+    Returns:
+    - inside (np.ndarray): Boolean array, True for windows intersecting the area.
+    """
+    height, width, transform = coarse_grid(src, window_size, cells)
+    area = rasterize(
+        [transform_geom("EPSG:4326", src.crs, geometry) for geometry in geometries],
+        out_shape=(height, width),
+        transform=transform,
+        all_touched=True,
+        dtype="uint8",
+    ).astype(bool)
+    return reduce_windows(area, src, windows, np.any)
+
+
+def crop_meta(meta, window):
+    """Metadata of the reference grid cropped to `window`."""
+    meta = meta.copy()
+    meta.update(
+        {
+            "width": window.width,
+            "height": window.height,
+            "transform": rasterio.windows.transform(window, meta["transform"]),
+        }
+    )
+    return meta
+
+
+def coarse_grid(src, window_size, cells=8):
+    """
+    Grid of `cells` x `cells` pixels per window covering `src`.
+
+    Returns:
+    - (height, width, transform) of the coarse grid.
+    """
+    factor = max(1, window_size // cells)
+    height = math.ceil(src.height / factor)
+    width = math.ceil(src.width / factor)
+    transform = src.transform * Affine.scale(src.width / width, src.height / height)
+    return height, width, transform
+
+
+def reduce_windows(coarse, src, windows, reducer):
+    """
+    Reduce the pixels of a `coarse_grid` array covered by every window.
+
+    Parameters:
+    - coarse (np.ndarray): Array on the coarse grid of `src`.
+    - src: Dataset on the grid of the windows.
+    - windows (list): rasterio.windows.Window objects on the grid of `src`.
+    - reducer (callable): e.g. np.any or np.mean.
+
+    Returns:
+    - np.ndarray with one value per window.
+    """
+    y_scale = coarse.shape[0] / src.height
+    x_scale = coarse.shape[1] / src.width
+    return np.array(
+        [
+            reducer(
+                coarse[
+                    math.floor(window.row_off * y_scale) : math.ceil((window.row_off + window.height) * y_scale),
+                    math.floor(window.col_off * x_scale) : math.ceil((window.col_off + window.width) * x_scale),
+                ]
+            )
+            for window in windows
+        ]
+    )
+
+
+def interleave_strips(classified, windows, classes, strip_rows):
+    """
+    Merge windows of known classes into a stream of classified strips.
+
+    The windows are grouped by strip like `strips` does, and every group is yielded
+    before the classified strip with the same or a later index, so the writer still
+    receives the windows row of tiles after row of tiles.
+
+    Parameters:
+    - classified: ((strip_window, windows), classes) tuples, in strip order.
+    - windows (list): Windows whose class is known, e.g. cloudy windows.
+    - classes (np.ndarray or int): Class of each window, or a single class for all of them,
+      with the probabilities of the windows as a second column when they are classified with them.
+    - strip_rows (int): Rows of a strip, as given to `strips`.
+
+    Yields:
+    - (windows, classes) tuples.
+    """
+    classes = np.broadcast_to(classes, (len(windows),) + np.shape(classes)[1:])
+    pending = {}
+    for window, value in zip(windows, classes):
+        group = pending.setdefault(window.row_off // strip_rows, ([], []))
+        group[0].append(window)
+        group[1].append(value)
+
+    def pop(key):
+        group_windows, group_classes = pending.pop(key)
+        return group_windows, np.array(group_classes, dtype=np.uint8)
+
+    for (strip_window, strip_windows), strip_classes in classified:
+        index = strip_windows[0].row_off // strip_rows
+        for key in sorted(key for key in pending if key <= index):
+            yield pop(key)
+        yield strip_windows, strip_classes
+    for key in sorted(pending):
+        yield pop(key)
+
+
+def strip_height(referenced_src, window_size):
+    """
+    Height of the strips read by `read_strip`.
+
+    The block of the finest band, as returned by `stack_assets`, is rounded up to a
+    multiple of the window size, so each strip covers whole block rows and whole
+    windows. Blocks of the resampled bands span several strips and are served from
+    the GDAL block cache.
+    """
+    block_rows = referenced_src.block_shapes[0][0]
+    return math.ceil(block_rows / window_size) * window_size
+
+
+def strips(windows, strip_rows):
+    """
+    Group windows into horizontal strips of `strip_rows` rows.
+
+    Returns:
+    - strips (list): (strip_window, windows) tuples, where strip_window is the
+      rasterio.windows.Window covering all the windows of the strip.
+    """
+    groups = {}
+    for window in windows:
+        groups.setdefault(window.row_off // strip_rows, []).append(window)
+
+    result = []
+    for strip_windows in groups.values():
+        col_off = min(w.col_off for w in strip_windows)
+        row_off = min(w.row_off for w in strip_windows)
+        width = max(w.col_off + w.width for w in strip_windows) - col_off
+        height = max(w.row_off + w.height for w in strip_windows) - row_off
+        result.append((Window(col_off, row_off, width, height), strip_windows))
+    return result
+
+
+def read_strip(strip, src, out=None):
+    """
+    Read a strip of every band with a single read.
+
+    Parameters:
+    - strip (tuple): (strip_window, windows) as returned by `strips`.
+    - src: Dataset stacking the bands, opened from the VRT of `stack_assets`.
+    - out (np.ndarray): uint16 array of the shape of `block` the bands are read into,
+      e.g. from `StripBuffers`, None to allocate a new one.
+
+    Returns:
+    - block (np.ndarray): Stacked bands of shape (num_bands, strip_window.height, strip_window.width).
+    """
+    strip_window, _ = strip
+    block = out if out is not None else np.empty((src.count, strip_window.height, strip_window.width), dtype=np.uint16)
+    src.read(window=strip_window, out=block)
+    return block
+
+
+class StripBuffers:
+    """
+    Fixed set of buffers the strips are read into, reused from strip to strip.
+
+    A buffer is taken by `read` and given back by `release` once the windows of its
+    strip are classified, so reading a scene allocates `count` buffers, grown to the
+    largest strip read, instead of one per strip. With `prefetch`, `count` must be
+    at least `queue_depth + 1`: the strips in flight and the one being classified.
+    """
+
+    def __init__(self, count):
+        self.free = queue.SimpleQueue()
+        for _ in range(count):
+            self.free.put(np.empty(0, dtype=np.uint16))
+
+    def read(self, strip, src):
+        """`read_strip` into a free buffer, as the `read_fn` of `prefetch`."""
+        strip_window, _ = strip
+        shape = (src.count, strip_window.height, strip_window.width)
+        buffer = self.free.get()
+        if buffer.size < math.prod(shape):
+            buffer = np.empty(math.prod(shape), dtype=np.uint16)
+        try:
+            return read_strip(strip, src, out=buffer[: math.prod(shape)].reshape(shape))
+        except BaseException:
+            self.free.put(buffer)
+            raise
+
+    def release(self, block):
+        self.free.put(block.base)
+
+
+def cut_windows(strip_window, block, windows):
+    """
+    Cut the windows of a strip out of its stacked bands, without copying.
+
+    Yields:
+    - (window, block) tuples, block having shape (num_bands, window.height, window.width).
+    """
+    for window in windows:
+        row = window.row_off - strip_window.row_off
+        col = window.col_off - strip_window.col_off
+        yield window, block[:, row : row + window.height, col : col + window.width]
+
+
+def raw_input(session):
+    """
+    True when the model takes the uint16 (N, num_bands, height, width) blocks as read,
+    the scaling to reflectances and the transpose being part of its graph.
+    """
+    return session.get_inputs()[0].type == "tensor(uint16)"
+
+
+def model_input(session, blocks):
+    """
+    Input of the model for stacked blocks of shape (N, num_bands, height, width).
+
+    Models with a raw input get the blocks as they are, without any copy when they
+    are contiguous. The other ones get reflectances of shape (N, height, width,
+    num_bands) in float32.
+    """
+    if raw_input(session):
+        return np.ascontiguousarray(blocks)
+    return np.transpose(blocks / REFLECTANCE_SCALE, (0, 2, 3, 1)).astype(np.float32)
+
+
 def predict(input_array, session, input_name, output_name):
 
     prediction_block = np.empty(
@@ -406,10 +1036,349 @@ def predict(input_array, session, input_name, output_name):
         dtype=np.uint8,
     )
     if np.all(input_array == 0):
-        prediction_block[:, :] = 10
+        prediction_block[:, :] = NO_DATA_CLASS
     else:
-        input_array = np.expand_dims(input_array, axis=0) / 10000.0
-        input_array = np.transpose(input_array, (0, 2, 3, 1)).astype(np.float32)
+        input_array = model_input(session, np.expand_dims(input_array, axis=0))
         pred = session.run([output_name], {input_name: input_array})[0]
         prediction_block[:, :] = np.argmax(pred[0], axis=-1)
     return prediction_block
+
+
+def predict_batch(input_arrays, session, input_name, output_name, probability=False):
+    """
+    Classify a batch of stacked window blocks with a single session call.
+
+    Parameters:
+    - input_arrays (np.ndarray): Blocks of shape (N, num_bands, window.height, window.width).
+    - session (onnxruntime.InferenceSession): Session running the tile classifier.
+    - probability (bool): Also return the probability of the predicted classes.
+
+    Returns:
+    - classes (np.ndarray): Predicted class of each block, shape (N,), or with `probability`
+      shape (N, 2) with the class probability, scaled by PROBABILITY_SCALE, as second column.
+    """
+    pred = session.run([output_name], {input_name: model_input(session, input_arrays)})[0]
+    return class_scores(pred.reshape(len(pred), -1), probability)
+
+
+def class_scores(scores, probability=False):
+    """
+    Class of each row of softmax `scores`, with its probability scaled by PROBABILITY_SCALE when asked.
+    """
+    classes = np.argmax(scores, axis=-1).astype(np.uint8)
+    if not probability:
+        return classes
+    probabilities = np.rint(np.max(scores, axis=-1) * PROBABILITY_SCALE).clip(0, PROBABILITY_SCALE)
+    return np.stack([classes, probabilities.astype(np.uint8)], axis=1)
+
+
+class BatchBuffers:
+    """
+    Buffers of the session calls classifying batches of windows, reused from batch to batch.
+
+    Windows are copied into `blocks`, the only copy between the strip and the model,
+    and the session reads its input from and writes its output to these buffers
+    through onnxruntime I/O binding, so classifying a batch allocates no array per
+    window. Models without a raw input get the reflectances in a float32 buffer,
+    computed in place with the same values as `model_input`. A binding holds the
+    buffers, so an instance must not be used by several threads at once.
+
+    Parameters:
+    - session (onnxruntime.InferenceSession): Session running the tile classifier.
+    - batch_size (int): Maximum number of windows per batch.
+    - window_shape (tuple): Shape of a window block, (num_bands, height, width).
+    """
+
+    def __init__(self, session, batch_size, window_shape):
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+        self.output_name = session.get_outputs()[0].name
+        self.raw = raw_input(session)
+        num_bands, height, width = window_shape
+        self.blocks = np.empty((batch_size, num_bands, height, width), dtype=np.uint16)
+        self.inputs = self.blocks if self.raw else np.empty((batch_size, height, width, num_bands), dtype=np.float32)
+        output = session.get_outputs()[0]
+        output_shape = output.shape[1:]
+        if not all(isinstance(dim, int) for dim in output_shape):
+            probe = np.zeros_like(self.inputs[:1])
+            output_shape = session.run([self.output_name], {self.input_name: probe})[0].shape[1:]
+        self.outputs = np.empty((batch_size, *output_shape), dtype=OUTPUT_TYPES[output.type])
+        self.bindings = {}
+
+    def binding(self, count):
+        """I/O binding of the first `count` windows of the buffers, one per batch size seen."""
+        if count not in self.bindings:
+            binding = self.session.io_binding()
+            inputs, outputs = self.inputs[:count], self.outputs[:count]
+            binding.bind_input(self.input_name, "cpu", 0, inputs.dtype, inputs.shape, inputs.ctypes.data)
+            binding.bind_output(self.output_name, "cpu", 0, outputs.dtype, outputs.shape, outputs.ctypes.data)
+            self.bindings[count] = binding
+        return self.bindings[count]
+
+    def predict(self, count, probability=False):
+        """
+        Classify the first `count` windows of `blocks`, as `predict_batch`.
+        """
+        if not self.raw:
+            np.divide(
+                self.blocks[:count].transpose(0, 2, 3, 1),
+                np.float32(REFLECTANCE_SCALE),
+                out=self.inputs[:count],
+                dtype=np.float32,
+            )
+        self.session.run_with_iobinding(self.binding(count))
+        return class_scores(self.outputs[:count].reshape(count, -1), probability)
+
+
+def window_values(count, value, probability=False):
+    """
+    Values of `count` windows of a known class, e.g. cloudy windows, shaped like the
+    ones of `classify_strip`. Their probability is unknown and set to no-data.
+    """
+    if not probability:
+        return np.full(count, value, dtype=np.uint8)
+    values = np.full((count, 2), NO_DATA_CLASS, dtype=np.uint8)
+    values[:, 0] = value
+    return values
+
+
+def output_cells(windows, stride=None):
+    """
+    Pixels each window's class is written to.
+
+    Without overlap (no stride, or a stride equal to the window size) a window
+    owns all of its pixels. With overlapping windows, each window owns the
+    `stride` x `stride` cell at its centre, so the cells tile the covered area.
+    """
+    if not stride:
+        return windows
+    cells = []
+    for window in windows:
+        row_margin = (window.height - stride) // 2
+        col_margin = (window.width - stride) // 2
+        cells.append(Window(window.col_off + col_margin, window.row_off + row_margin, stride, stride))
+    return cells
+
+
+def is_fully_convolutional(session):
+    """True when the model accepts any spatial size and returns a map of class scores."""
+    input_shape = session.get_inputs()[0].shape
+    output_shape = session.get_outputs()[0].shape
+    spatial_dims = input_shape[2:4] if raw_input(session) else input_shape[1:3]
+    return len(output_shape) == 4 and not all(isinstance(dim, int) for dim in spatial_dims)
+
+
+def network_stride(session, input_name, output_name, window_size, num_bands=12):
+    """
+    Distance in pixels between two neighbouring outputs of a fully-convolutional model.
+
+    Measured by growing a single window by `window_size` pixels.
+    """
+    sizes = []
+    for size in (window_size, 2 * window_size):
+        probe = model_input(session, np.zeros((1, num_bands, size, size), dtype=np.uint16))
+        sizes.append(session.run([output_name], {input_name: probe})[0].shape[2])
+    return window_size // (sizes[1] - sizes[0])
+
+
+def independent_windows(session, input_name, output_name, window_size, net_stride, num_bands=12):
+    """
+    True when the scores of a window run in a strip by a fully-convolutional model
+    are the scores of the window run alone.
+
+    Measured on two neighbouring random windows, run together and apart. The
+    convolutions with 'same' padding see the pixels of the neighbouring window
+    instead of zeros, so the scores of the windows differ.
+    """
+    pair = np.random.default_rng(0).integers(1, 10000, (1, num_bands, window_size, 2 * window_size), dtype=np.uint16)
+    together = session.run([output_name], {input_name: model_input(session, pair)})[0][0]
+    for i in range(2):
+        window = pair[..., i * window_size : (i + 1) * window_size]
+        alone = session.run([output_name], {input_name: model_input(session, window)})[0][0, 0, 0]
+        # Relative differences, the scores of a confident model being far below any absolute tolerance
+        if not np.allclose(together[0, i * window_size // net_stride], alone, rtol=1e-3, atol=1e-30):
+            return False
+    return True
+
+
+def predict_strip(
+    strip_window, block, windows, session, input_name, output_name, net_stride, max_width=1024, probability=False
+):
+    """
+    Classify the windows of a strip with a fully-convolutional model.
+
+    The strip is cut into regions of at most `max_width` columns holding whole
+    windows. Each region goes through the model once, so the convolutions shared
+    by neighbouring or overlapping windows are computed once. The output of a
+    window is the model output at its offset divided by `net_stride`.
+
+    Parameters:
+    - strip_window (rasterio.windows.Window): Window covered by `block`.
+    - block (np.ndarray): Stacked bands of the strip, as returned by `read_strip`.
+    - windows (list): Windows of the strip to classify.
+    - probability (bool): Also return the probability of the predicted classes.
+
+    Returns:
+    - classes (np.ndarray): Predicted class of each window, shape (len(windows),), or
+      (len(windows), 2) with `probability`, as `predict_batch`.
+    """
+    classes = np.empty((len(windows), 2) if probability else len(windows), dtype=np.uint8)
+    order = sorted(range(len(windows)), key=lambda i: windows[i].col_off)
+    regions = []
+    for i in order:
+        if not regions or windows[i].col_off + windows[i].width - regions[-1][0] > max_width:
+            regions.append((windows[i].col_off, []))
+        regions[-1][1].append(i)
+
+    for col_off, indexes in regions:
+        row_off = min(windows[i].row_off for i in indexes)
+        col_end = max(windows[i].col_off + windows[i].width for i in indexes)
+        row_end = max(windows[i].row_off + windows[i].height for i in indexes)
+        region = block[
+            :,
+            row_off - strip_window.row_off : row_end - strip_window.row_off,
+            col_off - strip_window.col_off : col_end - strip_window.col_off,
+        ]
+        scores = session.run([output_name], {input_name: model_input(session, region[np.newaxis])})[0][0]
+        rows = [(windows[i].row_off - row_off) // net_stride for i in indexes]
+        cols = [(windows[i].col_off - col_off) // net_stride for i in indexes]
+        classes[indexes] = class_scores(scores[rows, cols], probability)
+    return classes
+
+
+def classify_strip(
+    strip_window,
+    block,
+    windows,
+    session,
+    input_name,
+    output_name,
+    batch_size=64,
+    net_stride=None,
+    cache=None,
+    probability=False,
+    buffers=None,
+):
+    """
+    Classify the windows of a strip, empty windows never reaching the model.
+
+    Parameters:
+    - strip_window (rasterio.windows.Window): Window covered by `block`.
+    - block (np.ndarray): Stacked bands of the strip, as returned by `read_strip`.
+    - windows (list): Windows of the strip to classify.
+    - batch_size (int): Number of windows per session call.
+    - net_stride (int): Stride of a fully-convolutional model run with `predict_strip`,
+      None to classify the windows in batches with `BatchBuffers`.
+    - cache (PredictionCache): Cache of window classes checked before the model,
+      and filled with its results. Not used with `net_stride` nor `probability`.
+    - probability (bool): Also return the probability of the predicted classes.
+    - buffers (BatchBuffers): Buffers the batches are assembled in, kept across strips
+      by the caller, None to allocate them for this strip.
+
+    Returns:
+    - classes (np.ndarray): Predicted class of each window, NO_DATA_CLASS for empty
+      windows, shape (len(windows),), or (len(windows), 2) with `probability`, as `predict_batch`.
+    """
+    classes = window_values(len(windows), NO_DATA_CLASS, probability)
+    valid, blocks = [], []
+    for i, (window, arr_block) in enumerate(cut_windows(strip_window, block, windows)):
+        if arr_block.any():
+            valid.append(i)
+            blocks.append(arr_block)
+    if not valid:
+        return classes
+
+    if net_stride:
+        classes[valid] = predict_strip(
+            strip_window,
+            block,
+            [windows[i] for i in valid],
+            session,
+            input_name,
+            output_name,
+            net_stride,
+            probability=probability,
+        )
+        return classes
+
+    keys = []
+    if cache is not None and not probability:
+        keys = [cache.key(arr_block) for arr_block in blocks]
+        cached = cache.get(keys)
+        hit = cached >= 0
+        classes[np.array(valid)[hit]] = cached[hit]
+        missing = np.flatnonzero(~hit)
+        valid = [valid[i] for i in missing]
+        blocks = [blocks[i] for i in missing]
+        keys = [keys[i] for i in missing]
+
+    if buffers is None and valid:
+        buffers = BatchBuffers(session, batch_size, blocks[0].shape)
+    for start in range(0, len(valid), batch_size):
+        batch = blocks[start : start + batch_size]
+        for i, arr_block in enumerate(batch):
+            buffers.blocks[i] = arr_block
+        classes[valid[start : start + batch_size]] = buffers.predict(len(batch), probability=probability)
+    if keys:
+        cache.put(keys, classes[valid])
+    return classes
+
+
+def classify_stripes(
+    vrt, stripes, session, batch_size=64, net_stride=None, queue_depth=2, pool=None, cache=None, probability=False
+):
+    """
+    Classify stripes of windows in this process, reading them ahead with `prefetch`.
+
+    Strips are read into `StripBuffers` and batches assembled in `BatchBuffers`,
+    allocated once for all the stripes.
+
+    Yields:
+    - ((strip_window, windows), classes) tuples, in the order of `stripes`.
+    """
+    input_name = session.get_inputs()[0].name
+    output_name = session.get_outputs()[0].name
+    strip_buffers = StripBuffers(queue_depth + 1)
+    buffers = None
+    for (strip_window, windows), strip in prefetch(vrt, stripes, strip_buffers.read, queue_depth=queue_depth, pool=pool):
+        if buffers is None and not net_stride:
+            buffers = BatchBuffers(session, batch_size, (len(strip), windows[0].height, windows[0].width))
+        classes = classify_strip(
+            strip_window,
+            strip,
+            windows,
+            session,
+            input_name,
+            output_name,
+            batch_size=batch_size,
+            net_stride=net_stride,
+            cache=cache,
+            probability=probability,
+            buffers=buffers,
+        )
+        strip_buffers.release(strip)
+        yield (strip_window, windows), classes
+
+
+def shift_windows(windows, row_off, col_off):
+    """Windows moved to a grid whose origin is at (row_off, col_off)."""
+    if not row_off and not col_off:
+        return windows
+    return [Window(w.col_off - col_off, w.row_off - row_off, w.width, w.height) for w in windows]
+
+
+def scatter_predictions(prediction, windows, classes):
+    """
+    Broadcast the class of each window over its pixels in the prediction canvas.
+
+    Parameters:
+    - prediction (np.ndarray): Output canvas of shape (height, width).
+    - windows (list): rasterio.windows.Window objects, one per class.
+    - classes (np.ndarray or int): Class of each window, or a single class for all of them.
+    """
+    classes = np.broadcast_to(classes, (len(windows),))
+    for window, value in zip(windows, classes):
+        prediction[
+            window.row_off : window.row_off + window.height,
+            window.col_off : window.col_off + window.width,
+        ] = value
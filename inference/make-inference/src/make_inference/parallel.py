@@ -0,0 +1,129 @@
+from loguru import logger
+import multiprocessing
+import rasterio
+from .ml_helper import BatchBuffers, StripBuffers, classify_strip
+from .prediction_cache import PredictionCache
+from .remote import apply_remote_profile, block_cache_size, count_requests, raise_block_cache, request_counters
+from .session import create_session
+
+# State of a worker process, set by `_init_worker`
+_worker = {}
+
+
+def _init_worker(session_kwargs, cache_kwargs, remote_profile, report_requests):
+    _worker["session"] = create_session(**session_kwargs)
+    _worker["cache"] = PredictionCache(**cache_kwargs) if cache_kwargs else None
+    if report_requests:
+        count_requests()
+    _worker["remote_profile"] = remote_profile
+    if remote_profile:
+        apply_remote_profile()
+    _worker["vrt"] = None
+    _worker["src"] = None
+    # A worker classifies one stripe at a time, its buffers are reused by all of them
+    _worker["strip_buffers"] = StripBuffers(1)
+    _worker["buffers"] = None
+
+
+def _worker_source(vrt):
+    """Dataset handle of the worker, reopened when a new scene starts."""
+    if _worker["vrt"] != vrt:
+        if _worker["src"] is not None:
+            _worker["src"].close()
+        _worker["src"] = rasterio.open(vrt)
+        _worker["vrt"] = vrt
+        if _worker["remote_profile"]:
+            raise_block_cache(block_cache_size(vrt, readers=1))
+    return _worker["src"]
+
+
+def _classify_stripe(task):
+    vrt, (strip_window, windows), batch_size, net_stride, probability = task
+    session = _worker["session"]
+    cache = _worker["cache"]
+    counters = cache.counters() if cache else (0, 0)
+    requests = request_counters()
+    src = _worker_source(vrt)
+    # Jobs of `make-inference serve` may set their own batch size
+    buffers = _worker["buffers"]
+    if not net_stride and (buffers is None or len(buffers.blocks) != batch_size):
+        window_shape = (src.count, windows[0].height, windows[0].width)
+        _worker["buffers"] = BatchBuffers(session, batch_size, window_shape)
+    strip = _worker["strip_buffers"].read((strip_window, windows), src)
+    try:
+        classes = classify_strip(
+            strip_window,
+            strip,
+            windows,
+            session,
+            session.get_inputs()[0].name,
+            session.get_outputs()[0].name,
+            batch_size=batch_size,
+            net_stride=net_stride,
+            cache=cache,
+            probability=probability,
+            buffers=_worker["buffers"],
+        )
+    finally:
+        _worker["strip_buffers"].release(strip)
+    hits, misses = cache.counters() if cache else (0, 0)
+    fetched = request_counters()
+    return (
+        (strip_window, windows),
+        classes,
+        (hits - counters[0], misses - counters[1]),
+        (fetched[0] - requests[0], fetched[1] - requests[1]),
+    )
+
+
+class StripePool:
+    """
+    Classifies the stripes of a scene on a pool of worker processes.
+
+    Every worker opens its own rasterio handles and onnxruntime session, so reading,
+    preprocessing and inference of different stripes run on different cores without
+    sharing the GIL. Workers return one class per window, and the parent process
+    writes them into the prediction writer in stripe order. The pool is kept
+    across scenes. With `cache_kwargs`, every worker opens the prediction cache,
+    and the hits and misses of all the workers are counted here. With `report_requests`,
+    so are the HTTP requests of the workers, which apply the remote read profile with
+    `remote_profile`.
+    """
+
+    def __init__(self, workers, session_kwargs, cache_kwargs=None, remote_profile=False, report_requests=False):
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.bytes = 0
+        # Worker processes are spawned, as onnxruntime and GDAL threads do not survive a fork
+        self.pool = multiprocessing.get_context("spawn").Pool(
+            workers, initializer=_init_worker, initargs=(session_kwargs, cache_kwargs, remote_profile, report_requests)
+        )
+        logger.info(f"Started {workers} inference worker processes")
+
+    def classify(self, vrt, stripes, batch_size=64, net_stride=None, probability=False):
+        """
+        Yields:
+        - ((strip_window, windows), classes) tuples, in the order of `stripes`.
+        """
+        tasks = ((vrt, stripe, batch_size, net_stride, probability) for stripe in stripes)
+        for stripe, classes, (hits, misses), (requests, fetched) in self.pool.imap(_classify_stripe, tasks):
+            self.hits += hits
+            self.misses += misses
+            self.requests += requests
+            self.bytes += fetched
+            yield stripe, classes
+
+    def counters(self):
+        return self.hits, self.misses
+
+    def request_counters(self):
+        return self.requests, self.bytes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.pool.terminate() if exc[0] else self.pool.close()
+        self.pool.join()
@@ -0,0 +1,103 @@
+from loguru import logger
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+
+class PredictionCache:
+    """
+    Persistent cache of window classes, addressed by content.
+
+    The key of a window is the hash of the model file together with the hash of
+    its stacked uint16 block, so a window with the same pixels classified by the
+    same model is never sent to the session again, whatever the scene, product
+    version or pipeline change it comes from. Entries live in a SQLite database,
+    which can be shared by the worker processes and by runs, and the least
+    recently used entries are evicted beyond `max_entries`. The connection is shared
+    by the threads of the process, e.g. the concurrent jobs of `make-inference serve`.
+    """
+
+    def __init__(self, path, model_hash, max_entries=1_000_000):
+        self.path = path
+        self.prefix = bytes.fromhex(model_hash)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS predictions (key BLOB PRIMARY KEY, class INTEGER, used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS predictions_used ON predictions (used)")
+        # A cache filled with a larger `max_entries` is trimmed on open, whether or not the run adds entries
+        with self.lock:
+            self._evict()
+            self.db.commit()
+
+    def key(self, block):
+        """Key of a window block, as returned by `cut_windows`."""
+        digest = hashlib.blake2b(self.prefix, digest_size=20)
+        digest.update(str(block.shape).encode())
+        digest.update(np.ascontiguousarray(block).data)
+        return digest.digest()
+
+    def get(self, keys):
+        """
+        Returns the cached classes of `keys`, -1 for the missing ones, and marks the found ones as used.
+        """
+        classes = np.full(len(keys), -1, dtype=np.int16)
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                rows = self.db.execute(
+                    f"SELECT key, class FROM predictions WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self.db.executemany("UPDATE predictions SET used = ? WHERE key = ?", [(now, key) for key in found])
+                self.db.commit()
+            for i, key in enumerate(keys):
+                if key in found:
+                    classes[i] = found[key]
+
+            hits = int((classes >= 0).sum())
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return classes
+
+    def put(self, keys, classes):
+        now = time.time()
+        with self.lock:
+            cursor = self.db.executemany(
+                "INSERT OR REPLACE INTO predictions (key, class, used) VALUES (?, ?, ?)",
+                [(key, int(value), now) for key, value in zip(keys, classes)],
+            )
+            self.entries += cursor.rowcount
+            if self.entries > self.max_entries:
+                self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        # Other processes may have filled the database too, count again before evicting
+        self.entries = self.db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        excess = self.entries - self.max_entries
+        if excess > 0:
+            self.db.execute(
+                "DELETE FROM predictions WHERE key IN (SELECT key FROM predictions ORDER BY used LIMIT ?)",
+                (excess,),
+            )
+            self.entries -= excess
+            logger.debug(f"Evicted {excess} least recently used predictions from {self.path}")
+
+    def counters(self):
+        return self.hits, self.misses
+
+    def close(self):
+        self.db.close()
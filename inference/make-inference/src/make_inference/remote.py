@@ -0,0 +1,166 @@
+from loguru import logger
+import logging
+import math
+import re
+from xml.etree import ElementTree
+import numpy as np
+from rasterio.env import get_gdal_config, set_gdal_config
+
+# GDAL configuration of the remote read profile, for the COG and JP2 assets read over HTTP
+REMOTE_PROFILE = {
+    # Assets are opened by their (signed) href, the directories they are in are never listed
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    # The header and the tile index of a COG come with the first request
+    "GDAL_INGESTED_BYTES_AT_OPEN": "32768",
+    # Ranges of a read are fetched together, consecutive ones merged into a single range,
+    # on a single HTTP/2 connection multiplexing the requests when the server supports it
+    "GDAL_HTTP_VERSION": "2TLS",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "GDAL_HTTP_MULTIRANGE": "YES",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MAX_RETRY": "3",
+    "GDAL_HTTP_RETRY_DELAY": "1",
+    # Regions downloaded by any handle of the process, and per open dataset
+    "CPL_VSIL_CURL_CACHE_SIZE": str(256 << 20),
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": str(32 << 20),
+}
+
+# Debug messages of the HTTP requests sent by GDAL, as "VSICURL: Downloading 0-16383,16384-32767 (url)..."
+DOWNLOADING = re.compile(r"Downloading ((?:\d+-\d+,?)+) \(")
+FILE_SIZE = re.compile(r"GetFileSize\(")
+
+
+class RequestCounter(logging.Handler):
+    """
+    Counts the HTTP requests sent by GDAL and the bytes they fetch.
+
+    GDAL reports its requests as VSICURL debug messages, which rasterio forwards to
+    the `rasterio._env` and `rasterio._err` loggers, whatever thread sends them. The
+    counters are the ones of the process, e.g. of the concurrent jobs of
+    `make-inference serve` together, as the ones of the prediction cache.
+    """
+
+    loggers = ("rasterio._env", "rasterio._err")
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.requests = 0
+        self.bytes = 0
+        self.users = 0
+        self.previous = None
+
+    def start(self):
+        """
+        Turns the VSICURL debug messages on, and the rasterio loggers to DEBUG, until `stop`.
+
+        Must be called from the main thread, the GDAL configuration set from the other
+        threads only applying to them.
+        """
+        self.users += 1
+        if self.users > 1:
+            return
+        self.previous = (get_gdal_config("CPL_DEBUG"), [logging.getLogger(name).level for name in self.loggers])
+        if not self.previous[0]:
+            set_gdal_config("CPL_DEBUG", "VSICURL")
+        for name in self.loggers:
+            rasterio_logger = logging.getLogger(name)
+            rasterio_logger.addHandler(self)
+            rasterio_logger.setLevel(logging.DEBUG)
+
+    def stop(self):
+        """Restores the GDAL debug messages and the logger levels of before `start`."""
+        self.users -= 1
+        if self.users > 0:
+            return
+        cpl_debug, levels = self.previous
+        if not cpl_debug:
+            set_gdal_config("CPL_DEBUG", "OFF")
+        for name, level in zip(self.loggers, levels):
+            rasterio_logger = logging.getLogger(name)
+            rasterio_logger.removeHandler(self)
+            rasterio_logger.setLevel(level)
+
+    def emit(self, record):
+        message = record.getMessage()
+        match = DOWNLOADING.search(message)
+        if match:
+            self.requests += 1
+            for span in match.group(1).split(","):
+                start, end = span.split("-")
+                self.bytes += int(end) - int(start) + 1
+        elif FILE_SIZE.search(message):
+            self.requests += 1
+
+    def counters(self):
+        return self.requests, self.bytes
+
+
+_counter = RequestCounter()
+
+
+def count_requests():
+    """
+    Starts counting the HTTP requests of the process, and returns the RequestCounter.
+
+    GDAL then sends its debug messages through Python logging, so the requests are
+    only counted when asked, until `stop_counting`.
+    """
+    _counter.start()
+    return _counter
+
+
+def stop_counting():
+    _counter.stop()
+
+
+def request_counters():
+    """HTTP requests sent and bytes fetched by the process while the requests were counted."""
+    return _counter.counters()
+
+
+def apply_remote_profile():
+    """
+    Sets the GDAL configuration of REMOTE_PROFILE for the process.
+
+    Must be called from the main thread, as `RequestCounter.start`.
+    """
+    for key, value in REMOTE_PROFILE.items():
+        set_gdal_config(key, value)
+
+
+def block_cache_size(vrt, readers):
+    """
+    Bytes of GDAL block cache holding the blocks the strips of a scene read again.
+
+    Each reader holds a row of blocks of every band, the row a strip starts in. The
+    blocks of the resampled bands span several strips, and bilinear resampling also
+    reads the first row of blocks below, so those bands keep one more row.
+
+    Parameters:
+    - vrt (str): XML of the VRT of `stack_assets`, with the SourceProperties of the bands.
+    - readers (int): Number of strips read at the same time.
+    """
+    size = 0
+    for source in ElementTree.fromstring(vrt).iter("SimpleSource"):
+        properties = source.find("SourceProperties")
+        width = int(properties.get("RasterXSize"))
+        block_width = int(properties.get("BlockXSize"))
+        block_height = int(properties.get("BlockYSize"))
+        itemsize = np.dtype(properties.get("DataType").lower()).itemsize
+        block_row = math.ceil(width / block_width) * block_width * block_height * itemsize
+        size += block_row * (readers + (2 if source.get("resampling") else 1))
+    return size
+
+
+def raise_block_cache(size):
+    """
+    Grows the GDAL block cache of the process to `size` bytes, never shrinking it.
+
+    The cache is shared by all the scenes read at the same time, so the largest size
+    they need is kept.
+    """
+    current = int(get_gdal_config("GDAL_CACHEMAX"))
+    if size > current:
+        set_gdal_config("GDAL_CACHEMAX", size)
+        logger.info(f"GDAL block cache raised from {current >> 20} MB to {size >> 20} MB for the block layout of the scene")
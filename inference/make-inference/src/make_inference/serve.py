@@ -0,0 +1,307 @@
+from loguru import logger
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+import uuid
+import click
+import rasterio
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from .main import JOB_OPTIONS, Inference, run_inference
+
+# Finished jobs kept for the status endpoint, the oldest ones are forgotten first
+JOB_HISTORY = 1000
+
+
+class QueueFull(Exception):
+    pass
+
+
+def job_output_dir(root, job_id, output_dir=None):
+    """
+    Output directory of a job, `output_dir` of the request being a sub-directory of the service one.
+
+    Jobs cannot write outside the output directory of the service, e.g. with an
+    absolute path or `..`.
+    """
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, output_dir or job_id))
+    if path == root or os.path.commonpath([root, path]) != root:
+        raise click.UsageError("output_dir must be a sub-directory of the output directory of the service")
+    return path
+
+
+def job_params(defaults, request):
+    """
+    Parameters of a job, the ones of the service overridden by the JOB_OPTIONS of the request.
+
+    Values are checked with the types of the make-inference options, so a job accepts
+    the same values as the command line.
+
+    Parameters:
+    - defaults: parameters of the service
+    - request: JSON body of the job, with an `input_reference` string or list
+
+    Returns:
+    - the parameters given to `Inference.run`
+    """
+    unknown = set(request) - set(JOB_OPTIONS) - {"input_reference", "output_dir"}
+    if unknown:
+        raise click.UsageError(f"Unknown job options {sorted(unknown)}, jobs can set {JOB_OPTIONS}")
+    references = request.get("input_reference")
+    if isinstance(references, str):
+        references = [references]
+    if not references or not all(isinstance(reference, str) for reference in references):
+        raise click.UsageError("input_reference must be a STAC Item or Catalog url, or a list of them")
+    if not isinstance(request.get("output_dir", ""), str):
+        raise click.UsageError("output_dir must be a path")
+
+    params = dict(defaults, input_reference=tuple(references))
+    ctx = click.Context(run_inference)
+    options = {param.name: param for param in run_inference.params}
+    for name in JOB_OPTIONS:
+        if name in request:
+            params[name] = options[name].type_cast_value(ctx, request[name])
+    if params["bbox"] and params["aoi"]:
+        raise click.UsageError("bbox and aoi are mutually exclusive")
+    return params
+
+
+class JobQueue:
+    """
+    Runs the jobs submitted to the service on the shared Inference, `concurrency` at a time.
+
+    At most `max_queued` jobs wait for a free slot, later submissions are refused
+    until the queue drains.
+    """
+
+    def __init__(self, inference, params, output_dir, concurrency=1, max_queued=100):
+        self.inference = inference
+        self.params = params
+        self.output_dir = output_dir
+        self.max_queued = max_queued
+        self.jobs = {}
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="job")
+
+    def submit(self, request):
+        params = job_params(self.params, request)
+        self.inference.check_params(params)
+        job_id = uuid.uuid4().hex
+        output_dir = job_output_dir(self.output_dir, job_id, request.get("output_dir"))
+        with self.lock:
+            if sum(job["status"] == "queued" for job in self.jobs.values()) >= self.max_queued:
+                raise QueueFull(f"{self.max_queued} jobs are already queued")
+            job = {
+                "id": job_id,
+                "status": "queued",
+                "input_reference": list(params["input_reference"]),
+                "output_dir": output_dir,
+                "catalog": None,
+                "scenes": None,
+                "error": None,
+                "submitted": time.time(),
+                "started": None,
+                "finished": None,
+            }
+            self.jobs[job_id] = job
+            self.futures[job_id] = self.executor.submit(self._run, job, params)
+            self._forget()
+        logger.info(f"Job {job_id} queued for {job['input_reference']}")
+        return dict(job)
+
+    def _run(self, job, params):
+        job.update(status="running", started=time.time())
+        logger.info(f"Job {job['id']} started")
+        try:
+            catalog, scenes = self.inference.run(params, job["output_dir"])
+            job.update(status="succeeded", catalog=catalog, scenes=scenes)
+        except Exception as e:
+            logger.exception(f"Job {job['id']} failed")
+            job.update(status="failed", error=str(e))
+        job["finished"] = time.time()
+        logger.info(f"Job {job['id']} {job['status']} in {job['finished'] - job['started']:.2f}s")
+
+    def _forget(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job["finished"] is not None]
+        for job_id in finished[: max(0, len(finished) - JOB_HISTORY)]:
+            del self.jobs[job_id]
+            del self.futures[job_id]
+
+    def get(self, job_id, wait=False):
+        with self.lock:
+            job, future = self.jobs.get(job_id), self.futures.get(job_id)
+        if job is not None and wait:
+            future.result()
+        return None if job is None else dict(job)
+
+    def list(self):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def shutdown(self):
+        # Running jobs are completed, queued ones are dropped
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    """
+    JSON API of the service:
+
+    - POST /jobs: submits a job, `?wait=true` replies once it is finished
+    - GET /jobs: lists the jobs
+    - GET /jobs/{id}: status of a job, with the path of its catalog once succeeded
+    """
+
+    server_version = "make-inference"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts == ["jobs"]:
+            self.reply(HTTPStatus.OK, self.server.jobs.list())
+        elif len(parts) == 2 and parts[0] == "jobs":
+            job = self.server.jobs.get(parts[1], wait=wait_requested(url))
+            if job is None:
+                self.reply(HTTPStatus.NOT_FOUND, {"error": f"Unknown job {parts[1]}"})
+            else:
+                self.reply(HTTPStatus.OK, job)
+        else:
+            self.reply(HTTPStatus.NOT_FOUND, {"error": f"Unknown path {url.path}"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.strip("/") != "jobs":
+            self.reply(HTTPStatus.NOT_FOUND, {"error": f"Unknown path {url.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not isinstance(request, dict):
+                raise click.UsageError("The job must be a JSON object")
+            job = self.server.jobs.submit(request)
+        except (json.JSONDecodeError, click.ClickException) as e:
+            message = e.format_message() if isinstance(e, click.ClickException) else f"Invalid JSON: {e}"
+            self.reply(HTTPStatus.BAD_REQUEST, {"error": message})
+            return
+        except QueueFull as e:
+            self.reply(HTTPStatus.SERVICE_UNAVAILABLE, {"error": str(e)})
+            return
+        if wait_requested(url):
+            self.reply(HTTPStatus.OK, self.server.jobs.get(job["id"], wait=True))
+        else:
+            self.reply(HTTPStatus.ACCEPTED, job)
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Unix socket clients have no address, log the request only
+        logger.debug(format % args)
+
+
+def wait_requested(url):
+    return parse_qs(url.query).get("wait", ["false"])[0].lower() in ("1", "true", "yes")
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+@click.command(
+    name="serve",
+    short_help="serving tile-based classification jobs over a local HTTP API",
+    help="Keeps the model session, reader threads and GDAL caches warm, and classifies the STAC Items "
+    "of the jobs submitted as JSON to POST /jobs, e.g. {\"input_reference\": \"<item url>\", \"bbox\": [...]}. "
+    "Jobs can set the options " + ", ".join(JOB_OPTIONS) + ", the other options configure the service",
+    params=[param for param in run_inference.params if param.name != "input_reference"],
+)
+@click.option(
+    "--host",
+    "host",
+    help="Address to listen on",
+    default="127.0.0.1",
+    show_default=True,
+)
+@click.option(
+    "--port",
+    "port",
+    help="Port to listen on",
+    type=click.IntRange(min=0, max=65535),
+    default=8000,
+    show_default=True,
+    envvar="MAKE_INFERENCE_PORT",
+    show_envvar=True,
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    help="Unix socket to listen on, instead of --host and --port",
+    type=click.Path(dir_okay=False),
+    default=None,
+)
+@click.option(
+    "--jobs",
+    "concurrency",
+    help="Number of jobs classified at the same time, sharing the model session and the readers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    envvar="MAKE_INFERENCE_JOBS",
+    show_envvar=True,
+)
+@click.option(
+    "--max_queued",
+    "max_queued",
+    help="Number of jobs waiting for a free slot, above which submissions are refused",
+    type=click.IntRange(min=1),
+    default=100,
+    show_default=True,
+)
+@click.option(
+    "--output_dir",
+    "output_dir",
+    help="Directory of the job outputs, one {job id} sub-directory per job unless the job sets its own sub-directory as output_dir",
+    type=click.Path(file_okay=False),
+    default="jobs",
+    show_default=True,
+)
+def serve(host, port, socket_path, concurrency, max_queued, output_dir, **params):
+    if params["bbox"] and params["aoi"]:
+        raise click.UsageError("--bbox and --aoi are mutually exclusive")
+    # GDAL settings and caches live as long as the service
+    with rasterio.Env(), Inference(params) as inference:
+        jobs = JobQueue(inference, params, output_dir, concurrency=concurrency, max_queued=max_queued)
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = UnixHTTPServer(socket_path, JobHandler)
+            address = f"unix:{socket_path}"
+        else:
+            server = ThreadingHTTPServer((host, port), JobHandler)
+            address = f"http://{host}:{server.server_address[1]}"
+        server.jobs = jobs
+
+        # Stopped like an interrupt, the running jobs are completed first
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        logger.info(f"Serving inference jobs on {address} with {concurrency} concurrent jobs")
+        try:
+            server.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            logger.info("Stopping, waiting for the running jobs")
+        finally:
+            server.server_close()
+            jobs.shutdown()
+            if socket_path and os.path.exists(socket_path):
+                os.remove(socket_path)
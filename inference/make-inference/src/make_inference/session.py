@@ -0,0 +1,159 @@
+from loguru import logger
+import hashlib
+import os
+import platform
+import onnxruntime as ort
+
+
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model", "model.onnx")
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "make-inference")
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+# Variants written next to the FP32 model by the training `quantize-model` tool
+MODEL_VARIANTS = ["fp32", "int8_dynamic", "int8_static", "fp16"]
+
+EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    Returns the sha256 digest of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def variant_path(model_path, variant):
+    """
+    Path of a quantized variant of the model, `<name>_<variant>.onnx` next to it.
+    """
+    if variant == "fp32":
+        return model_path
+    name, extension = os.path.splitext(model_path)
+    path = f"{name}_{variant}{extension}"
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Model variant {variant} not found at {path}, build it with quantize-model")
+    return path
+
+
+def resolve_providers(providers):
+    """
+    Keeps the requested execution providers available in this onnxruntime build,
+    in the requested order, and always ends with the CPU provider.
+
+    Parameters:
+    - providers: list of provider names, e.g. ["CUDAExecutionProvider"], empty for the CPU only
+
+    Returns:
+    - list of provider names to pass to the session
+    """
+    available = ort.get_available_providers()
+    resolved = []
+    for provider in providers:
+        if provider not in available:
+            logger.warning(f"Execution provider {provider} is not available, available ones are {available}")
+        elif provider not in resolved:
+            resolved.append(provider)
+    if "CPUExecutionProvider" not in resolved:
+        resolved.append("CPUExecutionProvider")
+    return resolved
+
+
+def optimized_model_path(model_path, graph_optimization, providers, cache_dir):
+    """
+    Cache path of the graph optimized from `model_path`.
+
+    The key covers the model content, the optimization level, the execution providers,
+    the onnxruntime version and the machine, as optimized graphs may hold kernels and
+    layouts specific to any of them.
+    """
+    key = hashlib.sha256(
+        "|".join(
+            [
+                file_hash(model_path),
+                graph_optimization,
+                ",".join(providers),
+                ort.__version__,
+                platform.machine(),
+            ]
+        ).encode()
+    ).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(cache_dir, f"{name}-{graph_optimization}-{key}.onnx")
+
+
+def create_session(
+    model_path=DEFAULT_MODEL_PATH,
+    intra_op_threads=0,
+    inter_op_threads=0,
+    graph_optimization="all",
+    execution_mode="sequential",
+    memory_arena=True,
+    providers=(),
+    cache_dir=DEFAULT_CACHE_DIR,
+):
+    """
+    Creates the onnxruntime session running the model.
+
+    The first run saves the optimized graph into `cache_dir`. Later runs load it
+    with graph optimizations disabled, so the optimization cost is paid once per
+    model, onnxruntime version and machine.
+
+    Parameters:
+    - model_path: path to the ONNX model
+    - intra_op_threads: threads used inside an operator, 0 lets onnxruntime use all cores
+    - inter_op_threads: threads running independent operators in parallel execution mode, 0 for the default
+    - graph_optimization: one of GRAPH_OPTIMIZATION_LEVELS
+    - execution_mode: one of EXECUTION_MODES
+    - memory_arena: keep the CPU memory arena, disabling it lowers peak memory at some speed cost
+    - providers: execution providers in order of preference, the CPU provider is always added last
+    - cache_dir: directory of the optimized graphs, None to always optimize at startup
+
+    Returns:
+    - the onnxruntime InferenceSession
+    """
+    providers = resolve_providers(providers)
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.execution_mode = EXECUTION_MODES[execution_mode]
+    options.enable_cpu_mem_arena = memory_arena
+    options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[graph_optimization]
+
+    path = model_path
+    if cache_dir and graph_optimization != "disable":
+        cached_path = optimized_model_path(model_path, graph_optimization, providers, cache_dir)
+        if os.path.exists(cached_path):
+            logger.info(f"Loading optimized model from {cached_path}")
+            path = cached_path
+            options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS["disable"]
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            logger.info(f"Saving optimized model to {cached_path}")
+            # Written next to its final name and renamed once complete, so that an
+            # interrupted or concurrent run never loads a partial graph
+            tmp_path = f"{cached_path}.{os.getpid()}.tmp"
+            options.optimized_model_filepath = tmp_path
+
+    session = ort.InferenceSession(path, sess_options=options, providers=providers)
+    if options.optimized_model_filepath and os.path.exists(options.optimized_model_filepath):
+        os.replace(options.optimized_model_filepath, cached_path)
+
+    logger.info(
+        f"Model {model_path} running on {session.get_providers()} with {intra_op_threads or 'all'} intra-op threads, "
+        f"{execution_mode} execution and '{graph_optimization}' graph optimizations"
+    )
+    return session
@@ -0,0 +1,607 @@
+from loguru import logger
+import json
+import math
+import os
+import queue
+import re
+import signal
+import sys
+import threading
+from collections import OrderedDict, deque
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree
+import click
+import numpy as np
+import pystac
+import rasterio
+from rasterio.crs import CRS
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine, from_bounds
+from rasterio.warp import Resampling, reproject, transform_bounds
+from rasterio.windows import Window
+import rasterio.windows
+from planetary_computer import sign_url
+from .ml_helper import (
+    CLASS_COLORMAP,
+    NO_DATA_CLASS,
+    BatchBuffers,
+    StripBuffers,
+    classify_strip,
+    gdal_path,
+    item_filter_assets,
+    stack_assets,
+    strip_height,
+    strips,
+)
+from .main import SESSION_OPTIONS, model_session_kwargs, run_inference
+from .prediction_cache import PredictionCache
+from .remote import (
+    apply_remote_profile,
+    block_cache_size,
+    count_requests,
+    raise_block_cache,
+    request_counters,
+    stop_counting,
+)
+from .session import DEFAULT_CACHE_DIR, create_session, file_hash
+
+TILE_SIZE = 256
+WEB_MERCATOR = CRS.from_epsg(3857)
+# Extent of the Web Mercator grid, in meters
+WORLD_SIZE = 2 * math.pi * 6378137
+
+# The colormap of the COG outputs, with transparent no-data
+TILE_COLORMAP = {**CLASS_COLORMAP, NO_DATA_CLASS: (0, 0, 0, 0)}
+
+
+def tile_bounds(z, x, y):
+    """
+    Bounds of an XYZ tile as (left, bottom, right, top) in EPSG:3857.
+    """
+    size = WORLD_SIZE / 2**z
+    left = -WORLD_SIZE / 2 + x * size
+    top = WORLD_SIZE / 2 - y * size
+    return left, top - size, left + size, top
+
+
+def encode_png(tile):
+    """Paletted PNG of a tile of classes, coloured as the COG outputs."""
+    with MemoryFile() as memfile:
+        with memfile.open(driver="PNG", width=tile.shape[1], height=tile.shape[0], count=1, dtype="uint8") as dst:
+            dst.write(tile, 1)
+            dst.write_colormap(1, TILE_COLORMAP)
+        return memfile.read()
+
+
+class TileCache:
+    """
+    LRU cache of encoded tiles, bounded in memory and on disk.
+
+    Tiles evicted from memory stay on disk, and tiles found on disk are promoted
+    back to memory. The disk cache survives restarts, its least recently used
+    files being the ones with the oldest modification times.
+    """
+
+    def __init__(self, directory=None, memory_bytes=256 * 2**20, disk_bytes=2**30):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.disk = OrderedDict()
+        self.disk_size = 0
+        self.lock = threading.Lock()
+        if directory:
+            files = []
+            for root, _, names in os.walk(directory):
+                for name in names:
+                    if name.endswith(".png"):
+                        path = os.path.join(root, name)
+                        stat = os.stat(path)
+                        files.append((stat.st_mtime, path, stat.st_size))
+            for _, path, size in sorted(files):
+                self.disk[path] = size
+                self.disk_size += size
+            logger.info(f"Tile cache {directory} holds {len(self.disk)} tiles ({self.disk_size / 2**20:.1f} MB)")
+
+    def path(self, key):
+        return os.path.join(self.directory, *map(str, key)) + ".png"
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.memory or (self.directory is not None and self.path(key) in self.disk)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+            if self.directory is None or self.path(key) not in self.disk:
+                return None
+            path = self.path(key)
+            self.disk.move_to_end(path)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        self._remember(key, data)
+        if self.directory is None:
+            return
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.disk_size += len(data) - self.disk.pop(path, 0)
+            self.disk[path] = len(data)
+            while self.disk_size > self.disk_bytes and len(self.disk) > 1:
+                evicted, size = self.disk.popitem(last=False)
+                self.disk_size -= size
+                if os.path.exists(evicted):
+                    os.remove(evicted)
+
+    def _remember(self, key, data):
+        with self.lock:
+            self.memory_size += len(data) - len(self.memory.pop(key, b""))
+            self.memory[key] = data
+            while self.memory_size > self.memory_bytes and len(self.memory) > 1:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_size -= len(evicted)
+
+
+class SceneTiles:
+    """
+    Classifies the XYZ tiles of a Sentinel-2 STAC Item on demand.
+
+    A tile only reads and classifies the windows of the scene grid it covers, and
+    the classes of every window are kept, so overlapping tiles and other zoom levels
+    of the same area never classify a window twice. Tiles are reprojected from the
+    window classes to Web Mercator with nearest resampling.
+
+    The hrefs of the assets are signed again whenever a reader is taken, and the
+    readers opened with the hrefs of an expired token, e.g. a Planetary Computer
+    SAS token, are replaced, so the server outlives the tokens.
+    """
+
+    def __init__(self, item, session, window_size=64, batch_size=64, cache=None, gdal_threads="ALL_CPUS"):
+        self.item = item
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+        self.output_name = session.get_outputs()[0].name
+        self.window_size = window_size
+        self.batch_size = batch_size
+        self.cache = cache
+
+        self.hrefs = item_filter_assets(item, sign=False)
+        self.signed = {band: sign_url(href) for band, href in self.hrefs.items()}
+        self.vrt, referenced_src, _ = stack_assets(self.signed, threads=gdal_threads)
+        # Incremented whenever the VRT is rebuilt with renewed tokens
+        self.generation = 0
+        self.crs = referenced_src.crs
+        self.transform = referenced_src.transform
+        self.bounds = transform_bounds(self.crs, "EPSG:4326", *referenced_src.bounds, densify_pts=21)
+        self.strip_rows = strip_height(referenced_src, window_size)
+        # Windows of the scene grid, only the ones fully inside the scene as `sliding` does
+        self.rows = referenced_src.height // window_size
+        self.cols = referenced_src.width // window_size
+        self.classes = np.full((self.rows, self.cols), NO_DATA_CLASS, dtype=np.uint8)
+        self.done = np.zeros((self.rows, self.cols), dtype=bool)
+        # Windows being classified by a request, the other requests covering them wait for their classes
+        self.claimed = np.zeros((self.rows, self.cols), dtype=bool)
+        referenced_src.close()
+        self.ready = threading.Condition()
+        # Dataset handles are not thread safe, neither are the buffers the strips are classified in,
+        # each request classifies its windows with a reader of its own, kept for the next requests
+        # as (generation of its VRT, dataset, strip buffers, batch buffers)
+        self.readers = queue.SimpleQueue()
+        self.opened = []
+
+    def grid_range(self, bounds):
+        """
+        Rows and columns of the window grid covering EPSG:3857 `bounds`, None outside the scene.
+        """
+        window = rasterio.windows.from_bounds(
+            *transform_bounds(WEB_MERCATOR, self.crs, *bounds, densify_pts=21), transform=self.transform
+        )
+        row0 = max(0, math.floor(window.row_off / self.window_size))
+        row1 = min(self.rows, math.ceil((window.row_off + window.height) / self.window_size))
+        col0 = max(0, math.floor(window.col_off / self.window_size))
+        col1 = min(self.cols, math.ceil((window.col_off + window.width) / self.window_size))
+        if row0 >= row1 or col0 >= col1:
+            return None
+        return row0, row1, col0, col1
+
+    def classify(self, row0, row1, col0, col1):
+        """Classes of a range of the window grid, classifying the windows not seen yet."""
+        while True:
+            with self.ready:
+                done = self.done[row0:row1, col0:col1]
+                claimed = self.claimed[row0:row1, col0:col1]
+                # Windows claimed by other requests, e.g. the warm-up of the neighbouring tiles, are
+                # classified by them, the range waits for them once its own windows are classified
+                while not done.all() and claimed[~done].all():
+                    self.ready.wait()
+                if done.all():
+                    return self.classes[row0:row1, col0:col1].copy()
+                pending = np.argwhere(~done & ~claimed) + (row0, col0)
+                # One strip is claimed at a time, so a range never holds windows it is not classifying yet
+                strip_index = pending[:, 0] * self.window_size // self.strip_rows
+                pending = pending[strip_index == strip_index[0]]
+                self.claimed[pending[:, 0], pending[:, 1]] = True
+            self._classify_windows(pending)
+
+    def _classify_windows(self, pending):
+        size = self.window_size
+        windows = [Window(col * size, row * size, size, size) for row, col in pending]
+        reader = self._reader()
+        _, src, strip_buffers, buffers = reader
+        try:
+            for strip_window, strip_windows in strips(windows, self.strip_rows):
+                block = strip_buffers.read((strip_window, strip_windows), src)
+                try:
+                    classes = classify_strip(
+                        strip_window,
+                        block,
+                        strip_windows,
+                        self.session,
+                        self.input_name,
+                        self.output_name,
+                        batch_size=self.batch_size,
+                        cache=self.cache,
+                        buffers=buffers,
+                    )
+                finally:
+                    strip_buffers.release(block)
+                rows = [window.row_off // size for window in strip_windows]
+                cols = [window.col_off // size for window in strip_windows]
+                with self.ready:
+                    self.classes[rows, cols] = classes
+                    self.done[rows, cols] = True
+                    self.ready.notify_all()
+        finally:
+            self.readers.put(reader)
+            with self.ready:
+                # Windows left by a failure are claimed again by the next request covering them
+                self.claimed[pending[:, 0], pending[:, 1]] = False
+                self.ready.notify_all()
+        logger.debug(f"Classified {len(windows)} windows of {self.item.id}")
+
+    def _stack(self):
+        """
+        VRT of the scene with the hrefs signed now, and its generation.
+
+        `sign_url` renews the tokens about to expire, the VRT is then rebuilt with
+        the new hrefs. Hrefs needing no signature never change it.
+        """
+        signed = {band: sign_url(href) for band, href in self.hrefs.items()}
+        with self.ready:
+            if signed != self.signed:
+                vrt = ElementTree.fromstring(self.vrt)
+                # A source per band, in the order of the bands
+                for source, href in zip(vrt.iter("SourceFilename"), signed.values()):
+                    source.text = gdal_path(href)
+                self.vrt = ElementTree.tostring(vrt, encoding="unicode")
+                self.signed = signed
+                self.generation += 1
+                logger.info(f"Signed the assets of {self.item.id} with renewed tokens")
+            return self.vrt, self.generation
+
+    def _reader(self):
+        vrt, generation = self._stack()
+        while True:
+            try:
+                reader = self.readers.get_nowait()
+            except queue.Empty:
+                break
+            if reader[0] == generation:
+                return reader
+            # Opened with the hrefs of an expired token
+            with self.ready:
+                self.opened.remove(reader[1])
+            reader[1].close()
+        src = rasterio.open(vrt)
+        with self.ready:
+            self.opened.append(src)
+        size = self.window_size
+        return generation, src, StripBuffers(1), BatchBuffers(self.session, self.batch_size, (src.count, size, size))
+
+    def render(self, z, x, y):
+        """
+        Returns the classes of an XYZ tile, None when the tile is outside the scene.
+        """
+        bounds = tile_bounds(z, x, y)
+        grid_range = self.grid_range(bounds)
+        if grid_range is None:
+            return None
+        row0, _, col0, _ = grid_range
+        tile = np.full((TILE_SIZE, TILE_SIZE), NO_DATA_CLASS, dtype=np.uint8)
+        reproject(
+            self.classify(*grid_range),
+            tile,
+            src_transform=self.transform
+            * Affine.translation(col0 * self.window_size, row0 * self.window_size)
+            * Affine.scale(self.window_size),
+            src_crs=self.crs,
+            src_nodata=NO_DATA_CLASS,
+            dst_transform=from_bounds(*bounds, TILE_SIZE, TILE_SIZE),
+            dst_crs=WEB_MERCATOR,
+            dst_nodata=NO_DATA_CLASS,
+            resampling=Resampling.nearest,
+        )
+        return tile
+
+    def close(self):
+        with self.ready:
+            for src in self.opened:
+                src.close()
+
+
+class TileServer:
+    """
+    Serves the PNG tiles of a SceneTiles through a TileCache, and warms the tiles
+    around the requested ones on a background thread.
+    """
+
+    def __init__(self, scene, cache, model_key, min_zoom=10, max_zoom=18, warm=1):
+        self.scene = scene
+        self.cache = cache
+        self.model_key = model_key
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.warm = warm
+        self.empty = encode_png(np.full((TILE_SIZE, TILE_SIZE), NO_DATA_CLASS, dtype=np.uint8))
+        # Most recent requests are warmed first, older ones are dropped when panning away
+        self.pending = deque(maxlen=256)
+        self.wakeup = threading.Condition()
+        self.stopped = False
+        self.warmer = threading.Thread(target=self._warm, name="tile-warmer", daemon=True)
+        self.warmer.start()
+
+    def key(self, z, x, y):
+        return self.model_key, self.scene.item.id, z, x, y
+
+    def tile(self, z, x, y, warm=True):
+        """
+        Returns the PNG of a tile, None for a tile outside the served zoom levels.
+        """
+        if not self.min_zoom <= z <= self.max_zoom or not (0 <= x < 2**z and 0 <= y < 2**z):
+            return None
+        data = self.cache.get(self.key(z, x, y))
+        if data is None:
+            tile = self.scene.render(z, x, y)
+            data = self.empty if tile is None else encode_png(tile)
+            if tile is not None:
+                self.cache.put(self.key(z, x, y), data)
+        if warm and self.warm:
+            self.warm_around(z, x, y)
+        return data
+
+    def warm_around(self, z, x, y):
+        neighbours = [
+            (z, x + dx, y + dy)
+            for dy in range(-self.warm, self.warm + 1)
+            for dx in range(-self.warm, self.warm + 1)
+            if (dx or dy) and 0 <= x + dx < 2**z and 0 <= y + dy < 2**z
+        ]
+        with self.wakeup:
+            self.pending.extend(neighbour for neighbour in neighbours if self.key(*neighbour) not in self.cache)
+            self.wakeup.notify()
+
+    def _warm(self):
+        while True:
+            with self.wakeup:
+                while not self.pending and not self.stopped:
+                    self.wakeup.wait()
+                if self.stopped:
+                    return
+                z, x, y = self.pending.pop()
+            if self.key(z, x, y) in self.cache or self.scene.grid_range(tile_bounds(z, x, y)) is None:
+                continue
+            try:
+                self.tile(z, x, y, warm=False)
+            except Exception:
+                logger.exception(f"Warming tile {z}/{x}/{y} failed")
+
+    def close(self):
+        with self.wakeup:
+            self.stopped = True
+            self.wakeup.notify()
+        self.warmer.join()
+
+    def tilejson(self, url):
+        west, south, east, north = self.scene.bounds
+        return {
+            "tilejson": "2.2.0",
+            "name": f"{self.scene.item.id} classification",
+            "tiles": [f"{url}/{{z}}/{{x}}/{{y}}.png"],
+            "minzoom": self.min_zoom,
+            "maxzoom": self.max_zoom,
+            "bounds": [west, south, east, north],
+            "center": [(west + east) / 2, (south + north) / 2, self.min_zoom],
+        }
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    """
+    - GET /{z}/{x}/{y}.png: classification tile
+    - GET /tilejson.json: TileJSON of the served tiles
+    """
+
+    server_version = "make-inference"
+    tile_path = re.compile(r"^/(\d+)/(\d+)/(\d+)\.png$")
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        match = self.tile_path.match(path)
+        if match:
+            data = self.server.tiles.tile(*map(int, match.groups()))
+            if data is None:
+                self.reply(HTTPStatus.NOT_FOUND, "application/json", b'{"error": "Tile out of range"}')
+            else:
+                self.reply(HTTPStatus.OK, "image/png", data)
+        elif path == "/tilejson.json":
+            url = f"http://{self.headers.get('Host', '%s:%s' % self.server.server_address[:2])}"
+            self.reply(HTTPStatus.OK, "application/json", json.dumps(self.server.tiles.tilejson(url)).encode())
+        else:
+            self.reply(HTTPStatus.NOT_FOUND, "application/json", b'{"error": "Unknown path"}')
+
+    def reply(self, status, content_type, data):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+# Options of make-inference configuring the tile server, on top of SESSION_OPTIONS
+TILE_OPTIONS = [
+    "batch_size",
+    "gdal_threads",
+    "remote_profile",
+    "report_requests",
+    "prediction_cache",
+    "prediction_cache_entries",
+]
+
+
+@click.command(
+    name="tiles",
+    short_help="serving on-demand classification tiles of a sentinel-2 scene",
+    help="Serves /{z}/{x}/{y}.png tiles of the classification of a Sentinel-2 STAC Item, classifying "
+    "only the windows covering the requested tiles, with the colormap of the COG outputs",
+    params=[param for param in run_inference.params if param.name in SESSION_OPTIONS + TILE_OPTIONS],
+)
+@click.option(
+    "--input_reference",
+    "-i",
+    "input_reference",
+    help="Url to the Sentinel-2 STAC Item to classify",
+    type=click.Path(),
+    required=True,
+)
+@click.option(
+    "--host",
+    "host",
+    help="Address to listen on",
+    default="127.0.0.1",
+    show_default=True,
+)
+@click.option(
+    "--port",
+    "port",
+    help="Port to listen on",
+    type=click.IntRange(min=0, max=65535),
+    default=8080,
+    show_default=True,
+)
+@click.option(
+    "--tile_cache",
+    "tile_cache",
+    help="Directory of the cached tiles, by model and item",
+    type=click.Path(file_okay=False),
+    default=os.path.join(DEFAULT_CACHE_DIR, "tiles"),
+    show_default=True,
+    envvar="MAKE_INFERENCE_TILE_CACHE",
+    show_envvar=True,
+)
+@click.option(
+    "--memory_cache",
+    "memory_cache",
+    help="Megabytes of tiles kept in memory",
+    type=click.IntRange(min=1),
+    default=256,
+    show_default=True,
+)
+@click.option(
+    "--disk_cache",
+    "disk_cache",
+    help="Megabytes of tiles kept in --tile_cache, the least recently used ones are removed",
+    type=click.IntRange(min=1),
+    default=1024,
+    show_default=True,
+)
+@click.option(
+    "--min_zoom",
+    "min_zoom",
+    help="Lowest zoom level served, lower levels cover many windows and are slow to classify",
+    type=click.IntRange(min=0, max=24),
+    default=10,
+    show_default=True,
+)
+@click.option(
+    "--max_zoom",
+    "max_zoom",
+    help="Highest zoom level served",
+    type=click.IntRange(min=0, max=24),
+    default=18,
+    show_default=True,
+)
+@click.option(
+    "--warm",
+    "warm",
+    help="Tiles around a requested tile classified in the background, as a distance in tiles, 0 to disable",
+    type=click.IntRange(min=0),
+    default=1,
+    show_default=True,
+)
+def tiles(input_reference, host, port, tile_cache, memory_cache, disk_cache, min_zoom, max_zoom, warm, **params):
+    session_kwargs = model_session_kwargs(params)
+    session = create_session(**session_kwargs)
+    model_hash = file_hash(session_kwargs["model_path"])
+    cache = None
+    if params["prediction_cache"]:
+        cache = PredictionCache(
+            params["prediction_cache"], model_hash, max_entries=params["prediction_cache_entries"]
+        )
+
+    if params["report_requests"]:
+        count_requests()
+    if params["remote_profile"]:
+        apply_remote_profile()
+        logger.info("Reading the assets with the remote read profile")
+    item = pystac.read_file(input_reference)
+    if not isinstance(item, pystac.Item):
+        raise click.BadParameter("must be a STAC Item", param_hint="--input_reference")
+    scene = SceneTiles(
+        item, session, batch_size=params["batch_size"], cache=cache, gdal_threads=params["gdal_threads"]
+    )
+    if params["remote_profile"]:
+        # Tiles are classified one strip at a time, by the requested tiles and the warm-up
+        raise_block_cache(block_cache_size(scene.vrt, readers=2))
+    server = ThreadingHTTPServer((host, port), TileHandler)
+    server.tiles = TileServer(
+        scene,
+        TileCache(tile_cache, memory_bytes=memory_cache * 2**20, disk_bytes=disk_cache * 2**20),
+        model_hash[:16],
+        min_zoom=min_zoom,
+        max_zoom=max_zoom,
+        warm=warm,
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info(f"Serving tiles of {item.id} on http://{host}:{server.server_address[1]}/{{z}}/{{x}}/{{y}}.png")
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Stopping")
+    finally:
+        server.server_close()
+        server.tiles.close()
+        scene.close()
+        if cache is not None:
+            cache.close()
+        if params["report_requests"]:
+            requests, fetched = request_counters()
+            logger.info(f"Fetched {fetched / 2**20:.1f} MB in {requests} HTTP requests")
+            stop_counting()
@@ -0,0 +1,212 @@
+from loguru import logger
+import os
+import rasterio
+from rasterio.transform import Affine
+from rasterio.windows import Window
+import numpy as np
+from .ml_helper import (
+    CLASS_COLORMAP,
+    ClassStatistics,
+    NO_DATA_CLASS,
+    PROBABILITY_SCALE,
+    derive_overview,
+    save_prediction,
+    save_tiled_prediction,
+    output_cells,
+    scatter_predictions,
+    shift_windows,
+)
+
+
+class PredictionCanvas:
+    """
+    Keeps the whole classification in memory and writes it once prediction is over.
+
+    Peak memory grows with the scene size (one byte per pixel).
+    """
+
+    def __init__(self, meta, windows, stride=None, offset=(0, 0)):
+        self.meta = meta.copy()
+        self.stride = stride
+        self.offset = offset
+        self.prediction = np.full((meta["height"], meta["width"]), NO_DATA_CLASS, dtype=np.uint8)
+        self.stats = ClassStatistics(meta["height"], meta["width"])
+
+    def write(self, windows, classes):
+        windows = shift_windows(output_cells(windows, self.stride), *self.offset)
+        scatter_predictions(self.prediction, windows, classes)
+        self.stats.update(windows, classes)
+
+    def save(self, output_href, overview_href):
+        save_prediction(self.prediction, output_href, self.meta.copy())
+        derive_overview(output_href, overview_href)
+        del self.prediction
+
+
+class TiledPredictionWriter:
+    """
+    Streams the classification into a tiled uint8 GeoTIFF while prediction runs.
+
+    Windows are buffered per row of output tiles, and a row of tiles is written
+    and released as soon as all of its windows are classified, so memory does not
+    depend on the scene size. Tiles without any window are left empty and read back
+    as no-data. The COG outputs are produced from the tiled file by `save`.
+    """
+
+    def __init__(self, meta, windows, path, stride=None, offset=(0, 0), block_size=512):
+        self.path = path
+        self.stride = stride
+        self.offset = offset
+        self.block_size = block_size
+        self.width = meta["width"]
+        self.height = meta["height"]
+
+        self.remaining = {}
+        for window in shift_windows(output_cells(windows, stride), *offset):
+            for row in self._rows(window):
+                self.remaining[row] = self.remaining.get(row, 0) + 1
+        self.buffers = {}
+        self.stats = ClassStatistics(self.height, self.width)
+
+        profile = meta.copy()
+        profile.update(
+            {
+                "driver": "GTiff",
+                "dtype": "uint8",
+                "count": 1,
+                "tiled": True,
+                "blockxsize": block_size,
+                "blockysize": block_size,
+                "compress": None,
+                "nodata": NO_DATA_CLASS,
+            }
+        )
+        self.dst = rasterio.open(path, "w", **profile)
+        # The colormap must be set before any block is written
+        self.dst.write_colormap(1, CLASS_COLORMAP)
+
+    def _rows(self, window):
+        """Rows of tiles a window spans."""
+        return range(
+            window.row_off // self.block_size,
+            (window.row_off + window.height - 1) // self.block_size + 1,
+        )
+
+    def write(self, windows, classes):
+        windows = shift_windows(output_cells(windows, self.stride), *self.offset)
+        classes = np.broadcast_to(classes, (len(windows),))
+        self.stats.update(windows, classes)
+        for window, value in zip(windows, classes):
+            for row in self._rows(window):
+                if row not in self.buffers:
+                    height = min(self.block_size, self.height - row * self.block_size)
+                    self.buffers[row] = np.full((height, self.width), NO_DATA_CLASS, dtype=np.uint8)
+                top = row * self.block_size
+                row_start = max(window.row_off, top) - top
+                row_stop = min(window.row_off + window.height, top + self.block_size) - top
+                self.buffers[row][
+                    row_start:row_stop,
+                    window.col_off : window.col_off + window.width,
+                ] = value
+
+                self.remaining[row] -= 1
+                if self.remaining[row] == 0:
+                    self._flush(row)
+
+    def _flush(self, row):
+        buffer = self.buffers.pop(row)
+        self.dst.write(
+            buffer,
+            1,
+            window=Window(0, row * self.block_size, self.width, buffer.shape[0]),
+        )
+
+    def save(self, output_href, overview_href):
+        for row in list(self.buffers):
+            logger.warning(f"Row of tiles {row} is incomplete, writing it as is")
+            self._flush(row)
+        self.dst.close()
+
+        save_tiled_prediction(self.path, output_href, compress="deflate")
+        derive_overview(output_href, overview_href)
+        os.remove(self.path)
+
+
+class GridPredictionWriter:
+    """
+    Writes one pixel per window, on the grid of the windows, instead of broadcasting
+    the class of a window over its pixels.
+
+    The output pixel size is the stride (640 m for 64 pixel windows of a 10 m scene),
+    with the geotransform of the scene scaled accordingly, so the output is about
+    stride² times smaller than the other modes. Each window owns the pixel of its
+    `output_cells` cell. With `probability`, the classes come with the probability
+    of the class as a second column, written as a second band.
+    """
+
+    def __init__(self, meta, windows, stride=None, offset=(0, 0), window_size=64, probability=False):
+        self.meta = meta.copy()
+        self.stride = stride or window_size
+        self.offset = offset
+        self.probability = probability
+        # Origin of the cell of the first window
+        self.margin = (window_size - self.stride) // 2
+        self.height = max(0, (meta["height"] - window_size) // self.stride + 1)
+        self.width = max(0, (meta["width"] - window_size) // self.stride + 1)
+        bands = 2 if probability else 1
+        self.prediction = np.full((bands, self.height, self.width), NO_DATA_CLASS, dtype=np.uint8)
+        self.stats = ClassStatistics(
+            self.height, self.width, scales=(1.0, 1 / PROBABILITY_SCALE) if probability else (1.0,)
+        )
+
+    def write(self, windows, classes):
+        cells = shift_windows(output_cells(windows, self.stride), *self.offset)
+        rows = [(cell.row_off - self.margin) // self.stride for cell in cells]
+        cols = [(cell.col_off - self.margin) // self.stride for cell in cells]
+        values = np.broadcast_to(classes, (len(cells),) + np.shape(classes)[1:]).reshape(len(cells), -1)
+        self.prediction[:, rows, cols] = values.T
+        self.stats.update([Window(col, row, 1, 1) for row, col in zip(rows, cols)], classes)
+
+    def save(self, output_href, overview_href):
+        profile = self.meta.copy()
+        profile.update(
+            {
+                "driver": "COG",
+                "dtype": "uint8",
+                "count": len(self.prediction),
+                "width": self.width,
+                "height": self.height,
+                "transform": self.meta["transform"]
+                * Affine.translation(self.margin, self.margin)
+                * Affine.scale(self.stride),
+                "blocksize": 512,
+                "compress": "deflate",
+                "nodata": NO_DATA_CLASS,
+            }
+        )
+        with rasterio.open(output_href, "w", **profile) as dst:
+            dst.write(self.prediction)
+            dst.write_colormap(1, CLASS_COLORMAP)
+            if self.probability:
+                dst.scales = (1.0, 1 / PROBABILITY_SCALE)
+                dst.descriptions = ("class", "probability")
+        derive_overview(output_href, overview_href)
+
+
+def prediction_writer(
+    output_mode, meta, windows, path, stride=None, offset=(0, 0), window_size=64, probability=False
+):
+    """
+    Returns the writer receiving window classes for the given output mode.
+
+    `meta` describes the output grid, whose origin is at pixel `offset` (row, col)
+    of the grid of the windows, e.g. for an output cropped to an area of interest.
+    Only the grid mode writes the class probabilities.
+    """
+    if output_mode == "grid":
+        return GridPredictionWriter(
+            meta, windows, stride=stride, offset=offset, window_size=window_size, probability=probability
+        )
+    if output_mode == "canvas":
+        return PredictionCanvas(meta, windows, stride=stride, offset=offset)
+    return TiledPredictionWriter(meta, windows, path, stride=stride, offset=offset)
@@ -0,0 +1,322 @@
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import onnx
+import pytest
+import rasterio
+from onnx import TensorProto, helper
+from rasterio.transform import from_origin
+
+# Band assets of the test scene and their resolution in meters
+BANDS = {
+    "B01": 60,
+    "B02": 10,
+    "B03": 10,
+    "B04": 10,
+    "B05": 20,
+    "B06": 20,
+    "B07": 20,
+    "B08": 10,
+    "B8A": 20,
+    "B09": 60,
+    "B11": 20,
+    "B12": 20,
+}
+# Extent of the scene in meters, 768 pixels of 10m
+SCENE_SIZE = 7680
+ORIGIN = (500000, 5900040)
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves the files of `server.root` with single and multiple byte ranges, as a COG store does.
+
+    The first segment of the path is ignored, so the same files are served under
+    different urls, which GDAL caches separately. When the `tokens` of the state of
+    the server are set, only the urls with a `sig` query parameter in them are
+    served, as SAS tokens are. Every response is delayed by the `delay` of the state,
+    in seconds.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self.serve(body=False)
+
+    def do_GET(self):
+        self.serve(body=True)
+
+    def serve(self, body):
+        state = self.server.state
+        with self.server.lock:
+            state["requests"] += 1
+        time.sleep(state["delay"])
+        url = urlparse(self.path)
+        tokens = state["tokens"]
+        if tokens is not None and not set(parse_qs(url.query).get("sig", [])) & set(tokens):
+            self.send_response(403)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        path = os.path.join(self.server.root, os.path.basename(url.path))
+        # GDAL looks for the side-car files of a dataset too, unless told the directory is empty
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        spans = []
+        if self.headers.get("Range"):
+            for span in self.headers["Range"].split("=", 1)[1].split(","):
+                start, end = span.strip().split("-")
+                spans.append((int(start), min(int(end) if end else len(data) - 1, len(data) - 1)))
+
+        if not spans:
+            payload = data
+            self.send_response(200)
+        elif len(spans) == 1:
+            start, end = spans[0]
+            payload = data[start : end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        else:
+            payload = b""
+            for start, end in spans:
+                payload += (
+                    f"--BOUNDARY\r\nContent-Type: application/octet-stream\r\n"
+                    f"Content-Range: bytes {start}-{end}/{len(data)}\r\n\r\n"
+                ).encode()
+                payload += data[start : end + 1] + b"\r\n"
+            payload += b"--BOUNDARY--\r\n"
+            self.send_response(206)
+            self.send_header("Content-Type", "multipart/byteranges; boundary=BOUNDARY")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if body:
+            with self.server.lock:
+                state["bytes"] += len(payload)
+            self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope="session")
+def scene_dir(tmp_path_factory):
+    """Tiled and compressed GeoTIFFs of the 12 bands of a synthetic Sentinel-2 scene."""
+    directory = tmp_path_factory.mktemp("scene")
+    rng = np.random.default_rng(0)
+    for band, resolution in BANDS.items():
+        size = SCENE_SIZE // resolution
+        # Smooth fields compress like reflectances do
+        coarse = rng.integers(500, 4000, size=(size // 16 + 1, size // 16 + 1))
+        data = np.kron(coarse, np.ones((16, 16)))[:size, :size].astype(np.uint16)
+        data += rng.integers(0, 50, size=data.shape, dtype=np.uint16)
+        with rasterio.open(
+            directory / f"{band}.tif",
+            "w",
+            driver="GTiff",
+            width=size,
+            height=size,
+            count=1,
+            dtype="uint16",
+            crs="EPSG:32632",
+            transform=from_origin(*ORIGIN, resolution, resolution),
+            tiled=True,
+            blockxsize=128,
+            blockysize=128,
+            compress="deflate",
+        ) as dst:
+            dst.write(data, 1)
+    return directory
+
+
+class RangeServer:
+    """
+    Runs a RangeHandler server in a process of its own, GDAL holding the GIL of the
+    test process while it waits for a response.
+
+    The requests and bytes served, the accepted tokens and the delay of the responses
+    are shared with the server.
+    """
+
+    def __init__(self, root):
+        self.manager = multiprocessing.Manager()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+        self.httpd.root = root
+        self.httpd.state = self.manager.dict(requests=0, bytes=0, tokens=None, delay=0)
+        self.httpd.lock = self.manager.Lock()
+        self.server_address = self.httpd.server_address
+        self.process = multiprocessing.get_context("fork").Process(target=self.httpd.serve_forever, daemon=True)
+        self.process.start()
+
+    def __getattr__(self, name):
+        if name in ("requests", "bytes", "tokens", "delay"):
+            return self.httpd.state[name]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in ("requests", "bytes", "tokens", "delay"):
+            self.httpd.state[name] = value
+        else:
+            super().__setattr__(name, value)
+
+    def close(self):
+        self.process.terminate()
+        self.process.join()
+        self.httpd.server_close()
+        self.manager.shutdown()
+
+
+@pytest.fixture
+def range_server(scene_dir):
+    """HTTP server of the scene files supporting range requests, counting the requests and bytes it serves."""
+    server = RangeServer(str(scene_dir))
+    yield server
+    server.close()
+
+
+def write_item(path, base_url):
+    """STAC Item of the test scene with its band assets under `base_url`."""
+    assets = {
+        band: {
+            "href": f"{base_url}/{band}.tif",
+            "type": "image/tiff; application=geotiff",
+            "roles": ["data"],
+            "eo:bands": [{"name": band}],
+        }
+        for band in BANDS
+    }
+    item = {
+        "type": "Feature",
+        "stac_version": "1.0.0",
+        "stac_extensions": ["https://stac-extensions.github.io/eo/v1.1.0/schema.json"],
+        "id": "S2TEST",
+        "geometry": {"type": "Polygon", "coordinates": [[[9, 53.2], [9.1, 53.2], [9.1, 53.3], [9, 53.3], [9, 53.2]]]},
+        "bbox": [9, 53.2, 9.1, 53.3],
+        "properties": {"datetime": "2024-06-01T00:00:00Z"},
+        "links": [],
+        "assets": assets,
+    }
+    with open(path, "w") as f:
+        json.dump(item, f)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def model_path(tmp_path_factory):
+    """Small ONNX model with the input and output of the land cover classifier."""
+    weights = np.random.default_rng(1).normal(size=(12, 10)).astype(np.float32)
+    graph = helper.make_graph(
+        [
+            helper.make_node("ReduceMean", ["input"], ["mean"], axes=[1, 2], keepdims=0),
+            helper.make_node("MatMul", ["mean", "W"], ["logits"]),
+            helper.make_node("Softmax", ["logits"], ["output"], axis=-1),
+        ],
+        "classifier",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, ["N", 64, 64, 12])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, ["N", 10])],
+        [helper.make_tensor("W", TensorProto.FLOAT, weights.shape, weights.flatten())],
+    )
+    # IR version read by the onnxruntime releases of the environment
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8)
+    path = tmp_path_factory.mktemp("model") / "model.onnx"
+    onnx.save(model, path)
+    return str(path)
+
+
+def write_fcn_model(path, same_padding):
+    """
+    Small fully-convolutional ONNX model classifying 64 x 64 windows with a stride of 4,
+    its first convolution being 9 x 9 with 'same' padding, or 1 x 1 without padding.
+    """
+    rng = np.random.default_rng(2)
+    kernel = 9 if same_padding else 1
+    conv_weights = rng.normal(size=(8, 12, kernel, kernel)).astype(np.float32)
+    # Features centred on the mean reflectance of the test scene, so its windows get different classes
+    conv_bias = -conv_weights.sum(axis=(1, 2, 3)) * 0.2275
+    class_weights = rng.normal(size=(10, 8, 1, 1)).astype(np.float32)
+    graph = helper.make_graph(
+        [
+            helper.make_node("Transpose", ["input"], ["nchw"], perm=[0, 3, 1, 2]),
+            helper.make_node("Conv", ["nchw", "C", "B"], ["features"], pads=[kernel // 2] * 4),
+            helper.make_node("Relu", ["features"], ["relu"]),
+            helper.make_node("AveragePool", ["relu"], ["pooled"], kernel_shape=[64, 64], strides=[4, 4]),
+            helper.make_node("Conv", ["pooled", "K"], ["logits"]),
+            helper.make_node("Softmax", ["logits"], ["scores"], axis=1),
+            helper.make_node("Transpose", ["scores"], ["output"], perm=[0, 2, 3, 1]),
+        ],
+        "fcn_classifier",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, ["N", "H", "W", 12])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, ["N", "h", "w", 10])],
+        [
+            helper.make_tensor("C", TensorProto.FLOAT, conv_weights.shape, conv_weights.flatten()),
+            helper.make_tensor("B", TensorProto.FLOAT, conv_bias.shape, conv_bias),
+            helper.make_tensor("K", TensorProto.FLOAT, class_weights.shape, class_weights.flatten()),
+        ],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8)
+    onnx.save(model, path)
+    return str(path)
+
+
+def start_make_inference(item_path, model_path, output_dir, *args, **kwargs):
+    """
+    Starts make-inference on an item in its own process, in `output_dir`, with the
+    GDAL configuration and caches of a fresh process. `kwargs` are given to Popen.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([SRC_DIR, os.environ.get("PYTHONPATH", "")]))
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "make_inference.main",
+            "--input_reference",
+            str(item_path),
+            "--model",
+            str(model_path),
+            "--no_model_cache",
+            *args,
+        ],
+        cwd=output_dir,
+        env=env,
+        text=True,
+        **kwargs,
+    )
+
+
+def make_inference(item_path, model_path, output_dir, *args):
+    """
+    Runs make-inference on an item, as `start_make_inference`.
+
+    Returns:
+    - the completed process, its output captured
+    """
+    process = start_make_inference(
+        item_path, model_path, output_dir, *args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    stdout, stderr = process.communicate(timeout=600)
+    return subprocess.CompletedProcess(process.args, process.returncode, stdout, stderr)
+
+
+def read_classes(output_dir, item_id="S2TEST"):
+    """Classes of the classified output of an item."""
+    with rasterio.open(os.path.join(output_dir, f"{item_id}_classified", f"{item_id}_classified.tif")) as src:
+        return src.read(1)
+
+
+def read_raster_bands(output_dir, item_id="S2TEST"):
+    """raster:bands of the classified asset of the STAC Item of an item."""
+    with open(os.path.join(output_dir, f"{item_id}_classified", f"{item_id}_classified.json")) as f:
+        assets = json.load(f)["assets"]
+    return [asset["raster:bands"] for asset in assets.values() if "raster:bands" in asset]
@@ -0,0 +1,65 @@
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import pytest
+import rasterio
+from conftest import write_item
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+APP_PACKAGE = os.path.join(os.path.dirname(os.path.dirname(SRC_DIR)), "app-package", "tile-sat-inference.cwl")
+
+
+@pytest.mark.skipif(shutil.which("cwltool") is None, reason="cwltool is not installed")
+def test_app_package(tmp_path, range_server, model_path):
+    """
+    Runs the inference workflow with cwltool on the test scene, without a container,
+    so the expressions of the requirements are evaluated as in a real run.
+    """
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    # Entry point of the package, as installed in the container
+    entry_point = bin_dir / "make-inference"
+    entry_point.write_text(f'#!/bin/sh\nexec "{sys.executable}" -m make_inference.main "$@"\n')
+    entry_point.chmod(entry_point.stat().st_mode | stat.S_IEXEC)
+
+    base_url = f"http://127.0.0.1:{range_server.server_address[1]}"
+    item_path = write_item(tmp_path / "item.json", f"{base_url}/scene")
+    params = tmp_path / "params.json"
+    params.write_text(json.dumps({"input_reference": [item_path]}))
+
+    env = dict(
+        os.environ,
+        PATH=os.pathsep.join([str(bin_dir), os.environ["PATH"]]),
+        PYTHONPATH=os.pathsep.join([SRC_DIR, os.environ.get("PYTHONPATH", "")]),
+        MAKE_INFERENCE_MODEL=model_path,
+    )
+    result = subprocess.run(
+        [
+            "cwltool",
+            "--no-container",
+            "--preserve-environment",
+            "PYTHONPATH",
+            "--preserve-environment",
+            "MAKE_INFERENCE_MODEL",
+            "--outdir",
+            str(tmp_path / "out"),
+            f"{APP_PACKAGE}#tile-sat-inference",
+            str(params),
+        ],
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=600,
+    )
+    assert result.returncode == 0, result.stderr
+    results = json.loads(result.stdout)["results"]
+    # A single directory, in the Directory[] output of the scattered workflow
+    assert len(results) == 1
+    artifacts = results[0]["path"]
+    with rasterio.open(os.path.join(artifacts, "S2TEST_classified", "S2TEST_classified.tif")) as src:
+        assert src.read(1).max() <= 11
+    # The caches are written to the temporary directory of the step, not to its outputs
+    assert sorted(os.listdir(artifacts)) == ["S2TEST_classified", "catalog.json"]
@@ -0,0 +1,54 @@
+import os
+import subprocess
+import time
+import numpy as np
+from conftest import make_inference, read_classes, read_raster_bands, start_make_inference, write_item
+
+CHECKPOINT = "S2TEST_classified.checkpoint.npz"
+
+
+def checkpointed_windows(path):
+    """Windows completed in a checkpoint, 0 while it is not saved."""
+    try:
+        with np.load(path) as data:
+            return int(np.unpackbits(data["done"]).sum())
+    except (OSError, ValueError, KeyError):
+        return 0
+
+
+def test_resume(tmp_path, range_server, model_path):
+    """A run interrupted after a few windows and resumed gives the outputs of an uninterrupted run."""
+    item_path = write_item(tmp_path / "item.json", f"http://127.0.0.1:{range_server.server_address[1]}/scene")
+    args = ["--checkpoint", "--checkpoint_interval", "1", "--strip_rows", "64"]
+
+    expected_dir = tmp_path / "uninterrupted"
+    expected_dir.mkdir()
+    result = make_inference(item_path, model_path, str(expected_dir), *args)
+    assert result.returncode == 0, result.stderr
+
+    # Slow responses, so the run is killed between two checkpoints
+    range_server.delay = 0.05
+    output_dir = tmp_path / "interrupted"
+    output_dir.mkdir()
+    process = start_make_inference(
+        item_path, model_path, str(output_dir), *args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 300
+    while checkpointed_windows(output_dir / CHECKPOINT) == 0:
+        assert process.poll() is None, "the run ended before its first checkpoint"
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    process.kill()
+    process.wait()
+    interrupted_at = checkpointed_windows(output_dir / CHECKPOINT)
+    assert 0 < interrupted_at < 144
+
+    range_server.delay = 0
+    result = make_inference(item_path, model_path, str(output_dir), *args)
+    assert result.returncode == 0, result.stderr
+    assert f"{interrupted_at} of 144 windows already classified" in result.stderr
+    assert not os.path.exists(output_dir / CHECKPOINT)
+
+    assert np.array_equal(read_classes(output_dir), read_classes(expected_dir))
+    raster_bands = read_raster_bands(expected_dir)
+    assert raster_bands and read_raster_bands(output_dir) == raster_bands
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from conftest import make_inference, read_classes, write_fcn_model, write_item
+from make_inference.ml_helper import independent_windows, network_stride
+from make_inference.session import create_session
+
+
+@pytest.mark.parametrize("same_padding", [True, False])
+def test_independent_windows(tmp_path, same_padding):
+    session = create_session(write_fcn_model(tmp_path / "model.onnx", same_padding), cache_dir=None)
+    input_name, output_name = session.get_inputs()[0].name, session.get_outputs()[0].name
+    net_stride = network_stride(session, input_name, output_name, 64)
+    assert net_stride == 4
+    assert independent_windows(session, input_name, output_name, 64, net_stride) is not same_padding
+
+
+@pytest.mark.parametrize("same_padding", [True, False])
+def test_fcn_engine(tmp_path, scene_dir, same_padding):
+    """Without overlap, the fcn engine gives the classes of the window engine."""
+    model_path = write_fcn_model(tmp_path / "model.onnx", same_padding)
+    item_path = write_item(tmp_path / "item.json", str(scene_dir))
+    runs = {}
+    for engine in ("window", "fcn"):
+        output_dir = tmp_path / engine
+        output_dir.mkdir()
+        result = make_inference(item_path, model_path, str(output_dir), "--engine", engine)
+        assert result.returncode == 0, result.stderr
+        runs[engine] = read_classes(output_dir), result.stderr
+
+    assert np.array_equal(runs["window"][0], runs["fcn"][0])
+    assert len(np.unique(runs["fcn"][0])) > 1
+    # Only the model with 'same' padding classifies the windows separately
+    assert ("classifying the windows separately" in runs["fcn"][1]) is same_padding
@@ -0,0 +1,48 @@
+import itertools
+import types
+import numpy as np
+import pytest
+from make_inference import prediction_cache
+from make_inference.prediction_cache import PredictionCache
+
+MODEL_HASH = "ab" * 32
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    """A clock ticking at every call, so the entries are ordered by their last use."""
+    ticks = itertools.count()
+    monkeypatch.setattr(prediction_cache, "time", types.SimpleNamespace(time=lambda: float(next(ticks))))
+
+
+def window_keys(cache, count):
+    return [cache.key(np.full((12, 64, 64), value, dtype=np.uint16)) for value in range(count)]
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = PredictionCache(str(tmp_path / "cache.sqlite"), MODEL_HASH, max_entries=4)
+    keys = window_keys(cache, 6)
+    for i in range(4):
+        cache.put(keys[i : i + 1], [i])
+    # The first two windows are read again, the next two become the least recently used
+    assert cache.get(keys[:2]).tolist() == [0, 1]
+    cache.put(keys[4:6], [4, 5])
+
+    assert cache.entries == 4
+    assert cache.get(keys).tolist() == [0, 1, -1, -1, 4, 5]
+    cache.close()
+
+
+def test_trims_on_open(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = PredictionCache(path, MODEL_HASH, max_entries=6)
+    keys = window_keys(cache, 6)
+    cache.put(keys, list(range(6)))
+    cache.get(keys[3:4])
+    cache.get(keys[1:2])
+    cache.close()
+
+    cache = PredictionCache(path, MODEL_HASH, max_entries=2)
+    assert cache.entries == 2
+    assert cache.get(keys).tolist() == [-1, 1, -1, 3, -1, -1]
+    cache.close()
@@ -0,0 +1,41 @@
+import re
+import numpy as np
+from conftest import make_inference, read_classes, write_item
+
+FETCHED = re.compile(r"Fetched ([\d.]+) MB in (\d+) HTTP requests")
+
+
+def classify(item_path, model_path, output_dir, *args):
+    """
+    Runs make-inference on an item, the GDAL configuration and caches of the remote
+    profile being the ones of its process.
+
+    Returns:
+    - the classes of the output, and the (MB, requests) logged for the scene
+    """
+    result = make_inference(item_path, model_path, output_dir, "--report_requests", *args)
+    assert result.returncode == 0, result.stderr
+    megabytes, requests = FETCHED.search(result.stderr).groups()
+    return read_classes(output_dir), (float(megabytes), int(requests))
+
+
+def test_remote_profile(tmp_path, range_server, model_path):
+    base_url = f"http://127.0.0.1:{range_server.server_address[1]}"
+    runs = {}
+    for name, args in {"default": [], "profile": ["--remote_profile"]}.items():
+        # Each run reads its own urls, not to share the cached regions of the other one
+        item_path = write_item(tmp_path / f"{name}.json", f"{base_url}/{name}")
+        output_dir = tmp_path / name
+        output_dir.mkdir()
+        range_server.requests = range_server.bytes = 0
+        classes, logged = classify(item_path, model_path, str(output_dir), *args)
+        served = (range_server.bytes / 2**20, range_server.requests)
+        # The counter sees the reads, a few side-car probes of GDAL are only on stderr
+        assert 0 < logged[1] <= served[1]
+        assert abs(logged[0] - served[0]) < 0.1
+        runs[name] = classes, served
+
+    assert np.array_equal(runs["default"][0], runs["profile"][0])
+    assert runs["profile"][1][1] < runs["default"][1][1]
+    # Merged ranges may cover the small gaps between the blocks of a read
+    assert runs["profile"][1][0] < 1.1 * runs["default"][1][0]
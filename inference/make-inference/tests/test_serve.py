@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+import click
+import pytest
+from make_inference.main import run_inference
+from make_inference.serve import JobHandler, JobQueue, job_output_dir
+
+
+class RecordingInference:
+    """Stands for the Inference of the service, recording the output directories of the jobs."""
+
+    def __init__(self):
+        self.output_dirs = []
+
+    def check_params(self, params):
+        pass
+
+    def run(self, params, output_dir):
+        self.output_dirs.append(output_dir)
+        return os.path.join(output_dir, "catalog.json"), 0
+
+
+@pytest.fixture
+def service(tmp_path):
+    """Job service writing under `tmp_path / "jobs"`, with the defaults of the command line."""
+    ctx = click.Context(run_inference)
+    params = {param.name: param.get_default(ctx) for param in run_inference.params}
+    inference = RecordingInference()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), JobHandler)
+    server.jobs = JobQueue(inference, params, str(tmp_path / "jobs"))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.inference = inference
+    yield server
+    server.shutdown()
+    server.server_close()
+    server.jobs.shutdown()
+
+
+def submit(server, job):
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{server.server_address[1]}/jobs?wait=true", data=json.dumps(job).encode(), method="POST"
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+@pytest.mark.parametrize("output_dir", ["/tmp/escape", "../escape", "run/../../escape", ".", "run/.."])
+def test_escaping_output_dir(tmp_path, service, output_dir):
+    status, body = submit(service, {"input_reference": "item.json", "output_dir": output_dir})
+    assert status == 400
+    assert "sub-directory" in body["error"]
+    assert service.inference.output_dirs == []
+    assert not os.path.exists(tmp_path / "escape")
+
+
+def test_symlink_out_of_output_dir(tmp_path, service):
+    os.makedirs(tmp_path / "jobs")
+    os.symlink(tmp_path, tmp_path / "jobs" / "link")
+    status, _ = submit(service, {"input_reference": "item.json", "output_dir": "link/escape"})
+    assert status == 400
+
+
+def test_output_dir(tmp_path, service):
+    root = os.path.realpath(tmp_path / "jobs")
+    status, job = submit(service, {"input_reference": "item.json", "output_dir": "mine/run"})
+    assert status == 200 and job["status"] == "succeeded"
+    assert job["output_dir"] == os.path.join(root, "mine", "run")
+    assert service.inference.output_dirs == [job["output_dir"]]
+
+    # Without output_dir, a job writes to a sub-directory named after its id
+    _, job = submit(service, {"input_reference": "item.json"})
+    assert job["output_dir"] == os.path.join(root, job["id"])
+
+
+def test_job_output_dir(tmp_path):
+    root = os.path.realpath(tmp_path)
+    assert job_output_dir(str(tmp_path), "id") == os.path.join(root, "id")
+    assert job_output_dir(str(tmp_path), "id", "a/../b") == os.path.join(root, "b")
+    with pytest.raises(click.UsageError):
+        job_output_dir(str(tmp_path), "id", str(tmp_path.parent))
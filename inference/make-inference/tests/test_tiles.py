@@ -0,0 +1,29 @@
+import numpy as np
+import pystac
+from conftest import write_item
+from make_inference import tiles
+from make_inference.ml_helper import NO_DATA_CLASS
+from make_inference.session import create_session
+
+
+def test_renewed_token(tmp_path, range_server, model_path, monkeypatch):
+    """The readers opened with an expired token are replaced by readers of the renewed one."""
+    base_url = f"http://127.0.0.1:{range_server.server_address[1]}"
+    item = pystac.Item.from_file(write_item(tmp_path / "item.json", f"{base_url}/scene"))
+    token = {"sig": "first"}
+    monkeypatch.setattr(tiles, "sign_url", lambda href: f"{href}?sig={token['sig']}")
+    range_server.tokens = {"first"}
+
+    scene = tiles.SceneTiles(item, create_session(model_path, cache_dir=None))
+    try:
+        before = scene.classify(0, 2, 0, 2)
+        # The first token expires, the server refuses it from now on
+        token["sig"] = "second"
+        range_server.tokens = {"second"}
+        after = scene.classify(8, 10, 8, 10)
+    finally:
+        scene.close()
+
+    assert scene.generation == 1
+    assert "sig=second" in scene.vrt and "sig=first" not in scene.vrt
+    assert (before != NO_DATA_CLASS).all() and (after != NO_DATA_CLASS).all()
@@ -0,0 +1,171 @@
+import numpy as np
+import onnx
+import tensorflow as tf
+import tf2onnx
+from onnx import TensorProto, helper, numpy_helper
+from tensorflow.keras import layers
+from pathlib import Path
+from tile_based_training import logger
+
+
+# Sentinel-2 L2A digital numbers per unit of reflectance
+REFLECTANCE_SCALE = 10000.0
+
+
+def with_raw_input(model: onnx.ModelProto) -> onnx.ModelProto:
+    """Moves the preprocessing of the tiles into an ONNX model.
+
+    The model input, reflectances of shape (N, H, W, bands) in float32, is
+    replaced by the uint16 digital numbers of shape (N, bands, H, W) as
+    make-inference reads them, followed by a Cast, a division by the reflectance
+    scale and a Transpose. Integers below 2**24 are exact in float32, so the
+    graph computes the same reflectances as the NumPy preprocessing.
+
+    Args:
+        model (onnx.ModelProto): model taking reflectances, e.g. saved by `to_onnx`
+
+    Returns:
+        onnx.ModelProto: the same model taking raw blocks, under the same input name
+    """
+    graph = model.graph
+    original = graph.input[0]
+    name = original.name
+    if original.type.tensor_type.elem_type == TensorProto.UINT16:
+        return model
+    dims = [
+        dim.dim_value if dim.HasField("dim_value") else (dim.dim_param or None)
+        for dim in original.type.tensor_type.shape.dim
+    ]
+
+    reflectances = f"{name}_reflectances"
+    for node in graph.node:
+        for i, node_input in enumerate(node.input):
+            if node_input == name:
+                node.input[i] = reflectances
+
+    scale = numpy_helper.from_array(np.array(REFLECTANCE_SCALE, dtype=np.float32), name=f"{name}_scale")
+    graph.initializer.append(scale)
+    preprocessing = [
+        helper.make_node("Cast", [name], [f"{name}_float"], to=TensorProto.FLOAT, name=f"{name}_cast"),
+        helper.make_node("Div", [f"{name}_float", scale.name], [f"{name}_scaled"], name=f"{name}_div"),
+        helper.make_node("Transpose", [f"{name}_scaled"], [reflectances], perm=[0, 2, 3, 1], name=f"{name}_nhwc"),
+    ]
+    nodes = preprocessing + list(graph.node)
+    del graph.node[:]
+    graph.node.extend(nodes)
+
+    raw = helper.make_tensor_value_info(name, TensorProto.UINT16, [dims[0], dims[3], dims[1], dims[2]])
+    graph.input.remove(original)
+    graph.input.insert(0, raw)
+    onnx.checker.check_model(model)
+    return model
+
+
+class ExportModel:
+    def __init__(self, model: tf.keras.Model):
+        self.model = model
+
+    @staticmethod
+    def fully_convolutional(model: tf.keras.Model) -> tf.keras.Model:
+        """Rebuilds a trained tile classifier as a fully-convolutional model.
+
+        The first Dense layer after Flatten becomes a convolution whose kernel
+        covers the whole flattened feature map, and the following Dense layers
+        become 1x1 convolutions, with the same weights. Dropout layers are
+        dropped as they are inactive at inference.
+
+        On a 64x64 window the result equals the original model. On larger inputs
+        it returns one class score vector per window position, with a stride of
+        2 per pooling layer, while the convolutions shared by neighbouring windows
+        are computed once.
+
+        Args:
+            model (tf.keras.Model): trained Sequential model ending with Flatten/Dense layers
+
+        Returns:
+            tf.keras.Model: model taking inputs of any size >= the training window
+        """
+        same_padding = [
+            layer.name for layer in model.layers if getattr(layer, "padding", None) == "same"
+        ]
+        if same_padding:
+            logger.warning(
+                f"Layers {same_padding} use 'same' padding: on strips they see the neighbouring "
+                "pixels instead of the zero padding of a single window, make-inference --engine fcn "
+                "classifies the windows separately without overlap"
+            )
+
+        inputs = tf.keras.Input(shape=(None, None, model.input_shape[-1]), name="input")
+        x = inputs
+        flatten_shape = None
+        for layer in model.layers:
+            if isinstance(layer, layers.Dropout):
+                continue
+            if isinstance(layer, layers.Flatten):
+                flatten_shape = tuple(layer.input.shape[1:])
+                continue
+            if isinstance(layer, layers.Dense):
+                kernel, bias = layer.get_weights()
+                if flatten_shape is not None:
+                    kernel = kernel.reshape(*flatten_shape, -1)
+                    flatten_shape = None
+                else:
+                    kernel = kernel.reshape(1, 1, *kernel.shape)
+                conv = layers.Conv2D(
+                    kernel.shape[-1],
+                    kernel.shape[:2],
+                    activation=layer.activation,
+                    name=f"{layer.name}_conv",
+                )
+                x = conv(x)
+                conv.set_weights([kernel, bias])
+                continue
+
+            clone = layer.__class__.from_config(layer.get_config())
+            x = clone(x)
+            clone.set_weights(layer.get_weights())
+
+        return tf.keras.Model(inputs, x, name=f"{model.name}_fcn")
+
+    def check_fully_convolutional(self, fcn_model: tf.keras.Model, samples: int = 4) -> float:
+        """Largest difference between both models on random single windows."""
+        window = np.random.rand(samples, *self.model.input_shape[1:]).astype(np.float32)
+        expected = self.model.predict(window, verbose=0)
+        actual = fcn_model.predict(window, verbose=0).reshape(expected.shape)
+        return float(np.abs(expected - actual).max())
+
+    def to_onnx(
+        self, output_path: Path, fully_convolutional: bool = False, raw_input: bool = False, opset: int = 13
+    ):
+        """Saves the model in ONNX format for the make-inference module.
+
+        With `fully_convolutional`, the exported graph takes (N, H, W, bands)
+        inputs of any spatial size and returns (N, h, w, classes) scores, which
+        `make-inference --engine fcn` runs over whole strips.
+
+        With `raw_input`, the graph takes the uint16 (N, bands, H, W) blocks read
+        by make-inference instead, see `with_raw_input`, so the inference does not
+        scale nor transpose them.
+        """
+        model = self.model
+        shape = [None, *model.input_shape[1:]]
+        if fully_convolutional:
+            model = self.fully_convolutional(self.model)
+            logger.info(f"Fully-convolutional model max difference: {self.check_fully_convolutional(model)}")
+            shape = [None, None, None, model.input_shape[-1]]
+
+        input_signature = [tf.TensorSpec(shape, tf.float32, name="input")]
+
+        @tf.function(input_signature=input_signature)
+        def model_func(x):
+            return model(x)
+
+        onnx_model, _ = tf2onnx.convert.from_function(
+            model_func,
+            input_signature=input_signature,
+            opset=opset,
+            output_path=None if raw_input else str(output_path),
+        )
+        if raw_input:
+            onnx.save(with_raw_input(onnx_model), str(output_path))
+        logger.info(f"ONNX model saved at: {output_path}")
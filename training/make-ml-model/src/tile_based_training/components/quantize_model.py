@@ -0,0 +1,195 @@
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import onnx
+import onnxruntime as ort
+from pathlib import Path
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    CalibrationMethod,
+    QuantFormat,
+    QuantType,
+    quantize_dynamic,
+    quantize_static,
+)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+from onnxruntime.transformers.float16 import convert_float_to_float16
+from tile_based_training import logger
+from tile_based_training.utils.common import rasterio_read
+
+
+CLASS_NAMES = [
+    "AnnualCrop", "Forest", "HerbaceousVegetation", "Highway",
+    "Industrial", "Pasture", "PermanentCrop", "Residential",
+    "River", "SeaLake"
+]
+
+def variant_path(model_path: Path, variant: str) -> Path:
+    """Path of a model variant, saved next to the FP32 model as `<name>_<variant>.onnx`."""
+    model_path = Path(model_path)
+    if variant == "fp32":
+        return model_path
+    return model_path.with_name(f"{model_path.stem}_{variant}{model_path.suffix}")
+
+
+class TileDataReader(CalibrationDataReader):
+    """Feeds batches of preprocessed tiles to the static quantization calibration."""
+
+    def __init__(self, input_name: str, images: np.ndarray, batch_size: int = 16):
+        self.input_name = input_name
+        self.batches = iter(np.array_split(images, max(1, len(images) // batch_size)))
+
+    def get_next(self):
+        batch = next(self.batches, None)
+        return None if batch is None else {self.input_name: batch}
+
+
+class QuantizeModel:
+    def __init__(self, model_path: Path, splitted_data_path: Path):
+        self.model_path = Path(model_path)
+        self.splitted_data = json.load(open(splitted_data_path))
+        self.label_lookup = {name: idx for idx, name in enumerate(CLASS_NAMES)}
+
+    def load_tiles(self, split: str, max_samples: int = None):
+        """Reads the tiles of a split of `splitted_data.json` as model inputs.
+
+        Tiles are normalized as during training, without the random augmentations,
+        unless the model takes raw tiles (see `ExportModel.to_onnx`).
+
+        Args:
+            split (str): "train", "val" or "test"
+            max_samples (int): number of tiles to read, all of them if None
+
+        Returns:
+            tuple: float32 images of shape (N, 64, 64, 12), or uint16 images of shape
+                (N, 12, 64, 64) for a raw input model, and their class ids of shape (N,)
+        """
+        urls = self.splitted_data[split]["url"][:max_samples]
+        labels = self.splitted_data[split]["label"][:max_samples]
+        tiles = np.stack([rasterio_read(url) for url in urls])
+        if self.raw_input():
+            images = tiles.astype(np.uint16)
+        else:
+            images = np.transpose(tiles / 10000.0, (0, 2, 3, 1)).astype(np.float32)
+        logger.info(f"Loaded {len(urls)} tiles from the {split} split")
+        return images, np.array([self.label_lookup[label] for label in labels])
+
+    def input_name(self) -> str:
+        return onnx.load(self.model_path).graph.input[0].name
+
+    def raw_input(self) -> bool:
+        """True when the model takes uint16 tiles, with the normalization in its graph."""
+        return onnx.load(self.model_path).graph.input[0].type.tensor_type.elem_type == onnx.TensorProto.UINT16
+
+    def int8_dynamic(self) -> Path:
+        """Quantizes the weights to INT8, activations are quantized at run time."""
+        output_path = variant_path(self.model_path, "int8_dynamic")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            preprocessed = os.path.join(tmp_dir, "preprocessed.onnx")
+            quant_pre_process(str(self.model_path), preprocessed, skip_symbolic_shape=True)
+            quantize_dynamic(preprocessed, str(output_path), weight_type=QuantType.QInt8)
+        return output_path
+
+    def int8_static(self, calibration_images: np.ndarray) -> Path:
+        """Quantizes weights and activations to INT8, with activation ranges calibrated on tiles."""
+        output_path = variant_path(self.model_path, "int8_static")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            preprocessed = os.path.join(tmp_dir, "preprocessed.onnx")
+            quant_pre_process(str(self.model_path), preprocessed, skip_symbolic_shape=True)
+            quantize_static(
+                preprocessed,
+                str(output_path),
+                TileDataReader(self.input_name(), calibration_images),
+                quant_format=QuantFormat.QDQ,
+                per_channel=True,
+                activation_type=QuantType.QInt8,
+                weight_type=QuantType.QInt8,
+                calibrate_method=CalibrationMethod.MinMax,
+            )
+        return output_path
+
+    def fp16(self) -> Path:
+        """Casts weights and activations to FP16, keeping FP32 inputs and outputs."""
+        output_path = variant_path(self.model_path, "fp16")
+        model = convert_float_to_float16(onnx.load(self.model_path), keep_io_types=True)
+        onnx.save(model, output_path)
+        return output_path
+
+    @staticmethod
+    def benchmark(model_path: Path, images: np.ndarray, labels: np.ndarray, batch_size: int = 64, repeat: int = 3) -> dict:
+        """Measures a model on the CPU.
+
+        Args:
+            model_path (Path): ONNX model
+            images (np.ndarray): model inputs
+            labels (np.ndarray): class ids of the inputs
+            batch_size (int): windows per session call, as `make-inference --batch_size`
+            repeat (int): passes over the images, the fastest one is kept
+
+        Returns:
+            dict: median batch latency in ms and throughput in windows/s of the fastest pass,
+            the pass they were measured on, accuracy and model size in MB
+        """
+        session = ort.InferenceSession(str(model_path), providers=["CPUExecutionProvider"])
+        input_name = session.get_inputs()[0].name
+        batches = [images[i : i + batch_size] for i in range(0, len(images), batch_size)]
+        session.run(None, {input_name: batches[0]})
+
+        # Latency and throughput both come from the fastest pass
+        best = None
+        for _ in range(repeat):
+            latencies, predictions = [], []
+            start = time.perf_counter()
+            for batch in batches:
+                batch_start = time.perf_counter()
+                scores = session.run(None, {input_name: batch})[0]
+                latencies.append(time.perf_counter() - batch_start)
+                predictions.append(np.argmax(scores.reshape(len(batch), -1), axis=1))
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best[0]:
+                best = (elapsed, latencies, predictions)
+        elapsed, latencies, predictions = best
+
+        return {
+            "latency_ms": float(np.median(latencies) * 1000),
+            "throughput": len(images) / elapsed,
+            "pass": f"fastest of {repeat}",
+            "accuracy": float(np.mean(np.concatenate(predictions) == labels)),
+            "size_mb": os.path.getsize(model_path) / 2**20,
+        }
+
+    def run(self, calibration_samples: int = 200, test_samples: int = None, batch_size: int = 64) -> dict:
+        """Builds all the variants and compares them on the test split.
+
+        Args:
+            calibration_samples (int): train tiles used for the static calibration
+            test_samples (int): test tiles used for the comparison, all of them if None
+            batch_size (int): windows per session call in the benchmark
+
+        Returns:
+            dict: benchmark results per variant
+        """
+        calibration_images, _ = self.load_tiles("train", calibration_samples)
+        test_images, test_labels = self.load_tiles("test", test_samples)
+
+        paths = {
+            "fp32": self.model_path,
+            "int8_dynamic": self.int8_dynamic(),
+            "int8_static": self.int8_static(calibration_images),
+            "fp16": self.fp16(),
+        }
+        report = {}
+        for variant, path in paths.items():
+            report[variant] = self.benchmark(path, test_images, test_labels, batch_size=batch_size)
+            logger.info(f"{variant} saved at: {path}")
+
+        lines = [f"{'variant':<14}{'latency (ms)':>14}{'windows/s':>12}{'accuracy':>10}{'size (MB)':>11}"]
+        for variant, result in report.items():
+            lines.append(
+                f"{variant:<14}{result['latency_ms']:>14.2f}{result['throughput']:>12.1f}"
+                f"{result['accuracy']:>10.4f}{result['size_mb']:>11.2f}"
+            )
+        logger.info("Latency and throughput of the fastest pass of every variant\n" + "\n".join(lines))
+        return report
@@ -0,0 +1,78 @@
+import json
+import warnings
+import click
+from pathlib import Path
+from tile_based_training import logger
+from tile_based_training.components.quantize_model import QuantizeModel
+
+warnings.filterwarnings("ignore")
+
+
+@click.command(
+    short_help="building quantized variants of the ONNX model",
+    help="Builds INT8 dynamic, INT8 static and FP16 variants of an ONNX model next to it and compares "
+    "their CPU latency, throughput and accuracy on the test split",
+)
+@click.option(
+    "--model",
+    "model_path",
+    help="Path to the FP32 ONNX model",
+    type=click.Path(exists=True, dir_okay=False),
+    required=True,
+)
+@click.option(
+    "--splitted_data",
+    "splitted_data_path",
+    help="splitted_data.json written by the data ingestion stage",
+    type=click.Path(exists=True, dir_okay=False),
+    default="output/data_ingestion/splitted_data.json",
+    show_default=True,
+)
+@click.option(
+    "--calibration_samples",
+    "calibration_samples",
+    help="Number of train tiles calibrating the INT8 static variant",
+    type=click.IntRange(min=1),
+    default=200,
+    show_default=True,
+)
+@click.option(
+    "--test_samples",
+    "test_samples",
+    help="Number of test tiles used for the comparison, all of them by default",
+    type=click.IntRange(min=1),
+    default=None,
+)
+@click.option(
+    "--batch_size",
+    "batch_size",
+    help="Number of windows per session call in the benchmark",
+    type=click.IntRange(min=1),
+    default=64,
+    show_default=True,
+)
+@click.option(
+    "--report",
+    "report_path",
+    help="Path of the JSON report",
+    type=click.Path(dir_okay=False),
+    default="quantization_report.json",
+    show_default=True,
+)
+def run_quantization(model_path, splitted_data_path, calibration_samples, test_samples, batch_size, report_path):
+    quantizer = QuantizeModel(Path(model_path), Path(splitted_data_path))
+    report = quantizer.run(
+        calibration_samples=calibration_samples,
+        test_samples=test_samples,
+        batch_size=batch_size,
+    )
+    json.dump(report, open(report_path, "w"), indent=2)
+    logger.info(f"Report saved at: {report_path}")
+
+
+def main():
+    run_quantization()
+
+
+if __name__ == "__main__":
+    main()